@@ -11,6 +11,48 @@
 
 import shutil, errno
 import getopt, sys, os
+import threading
+import Queue
+import time
+import marshal
+import hashlib
+import tempfile
+import ctypes, ctypes.util
+
+# scandir reuses the file type returned with each directory entry (d_type)
+# instead of stat'ing every entry: os.scandir on 3.5+, otherwise the backport
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# the kernel copy and hole detection are only used on Linux, other
+# platforms number SEEK_DATA/SEEK_HOLE differently (swapped on OS X)
+linux = sys.platform.startswith("linux")
+# lseek whence values for finding data/holes in sparse files
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+# largest chunk handed to the kernel at a time
+CHUNK = 64 * 1024 * 1024
+
+libc = None
+if linux:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    except OSError:
+        pass
+if libc != None:
+    # declared so 64 bit offsets and sizes aren't truncated to an int
+    if hasattr(libc, "copy_file_range"):
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+                ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+    if hasattr(libc, "sendfile"):
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+        libc.sendfile.restype = ctypes.c_ssize_t
 
 allowable = [
     ".dll", 
@@ -25,61 +67,423 @@ def usage():
     print "  - collects files specified in a text file) from one 'disk' to another"
     print "\t-h, --help      : Print this help message"
     print "\t-s, --source    : Source folder/mount point"
-    print "\t-t, --target    : Target folder for collected files (must be absolute and non-existent before running)"
+    print "\t-t, --target    : Target folder for collected files (must be absolute, rerunning with the same target resumes a collection)"
     print "\t-f, --files     : List of files to collect"
     print "\t-d, --driverloc : Location of pathless drivers to cut down on runtime\n"
-    print "\t-a, --allfiles  : Collect all files and not just those in allowable extensions (off by default)\n"
+    print "\t-a, --allfiles  : Collect all files and not just those in allowable extensions (off by default)"
+    print "\t-w, --workers   : Number of files to copy concurrently (default 8)"
+    print "\t-j, --journal   : Journal of completed copies (default <target>/collect.journal)"
+    print "\t-i, --index     : File to cache the filename index used for pathless files in, reused for the same source"
+    print "\t                    (delete it to reindex after the source changes)"
+    print "\t-c, --cas       : Store each unique file once under <target>/blobs by SHA256 and write"
+    print "\t                    <target>/manifest.txt mapping the original paths to their hashes"
+    print "\t-z, --zerocopy  : Copy in the kernel (copy_file_range/sendfile) where possible and keep holes in"
+    print "\t                    sparse files on Linux, falls back to a normal copy otherwise (ignored with -c)\n"
     print "Example usage:\n   $ python collect.py -s /path/to/source -t /path/to/target -f /path/to/filelist.txt"
 
+class CopyEngine:
+    '''
+    Copies files with a pool of worker threads, which helps on high latency
+    sources like F-Response or network disks.  Each completed copy is
+    appended to a journal so an interrupted collection can be rerun and
+    only copies what is missing.
+
+    If store is set, files are hashed while they are copied and each unique
+    file is kept once under store/<sha256[:2]>/<sha256>, with manifest
+    recording sha256, md5, sha1, size, source and collected path.
+    '''
+    def __init__(self, journal, workers = 8, store = None, manifest = None, copier = shutil.copy2):
+        self.workers = workers
+        self.copier = copier
+        self.journalname = journal
+        self.store = store
+        self.manifestname = manifest
+        self.duplicates = 0
+        self.dupbytes = 0
+        self.done = {}
+        self.resumed = set()
+        self.planned = set()
+        self.queued = set()
+        self.existing = {}
+        self.jobs = []
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        if os.path.isfile(journal):
+            f = open(journal, "r")
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                # only count entries written in the same mode, a copy is
+                # not in the store and a stored file was never copied
+                if len(fields) == 3 and self.store == None:
+                    self.done[(fields[0], os.path.dirname(fields[1]))] = fields[1]
+                elif len(fields) == 4 and self.store != None:
+                    # stored by hash, so check for the blob
+                    self.done[(fields[0], os.path.dirname(fields[1]))] = self.blob(fields[3])
+            f.close()
+
+    def add(self, src, dst):
+        if self.copied(src, os.path.dirname(dst)):
+            return
+        self.planned.add(dst)
+        self.queued.add((os.path.normpath(src), os.path.normpath(os.path.dirname(dst))))
+        self.jobs.append((src, dst))
+
+    def copied(self, src, dstdir):
+        # the same file can be collected into more than one target directory,
+        # but only once into each, whether it was copied before or this run
+        if (os.path.normpath(src), os.path.normpath(dstdir)) in self.queued:
+            return True
+        key = (src, dstdir)
+        if key in self.done and os.path.exists(self.done[key]):
+            self.resumed.add(key)
+            return True
+        return False
+
+    def taken(self, dst):
+        if dst in self.planned:
+            return True
+        # list each target directory once rather than stat'ing every candidate name
+        dstdir, fname = os.path.split(dst)
+        if dstdir not in self.existing:
+            try:
+                self.existing[dstdir] = set(os.listdir(dstdir))
+            except OSError:
+                self.existing[dstdir] = set()
+        return fname in self.existing[dstdir]
+
+    def blob(self, digest):
+        return os.path.join(self.store, digest[:2], digest)
+
+    def _store(self, src):
+        '''
+        Copies src into the store while hashing it, returns (size, sha256, md5, sha1)
+        '''
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir = self.store, prefix = ".tmp")
+        try:
+            out = os.fdopen(fd, "wb")
+            f = open(src, "rb")
+            try:
+                while True:
+                    block = f.read(1024 * 1024)
+                    if not block:
+                        break
+                    sha256.update(block)
+                    md5.update(block)
+                    sha1.update(block)
+                    out.write(block)
+                    size += len(block)
+            finally:
+                f.close()
+                out.close()
+            digest = sha256.hexdigest()
+            blob = self.blob(digest)
+            with self.lock:
+                if os.path.exists(blob):
+                    self.duplicates += 1
+                    self.dupbytes += size
+                else:
+                    try:
+                        os.makedirs(os.path.dirname(blob))
+                    except OSError as exc:
+                        if exc.errno != errno.EEXIST:
+                            raise
+                    os.rename(tmp, blob)
+                    shutil.copystat(src, blob)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return size, digest, md5.hexdigest(), sha1.hexdigest()
+
+    def _worker(self, jobs, journal, manifest):
+        while True:
+            try:
+                src, dst = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if self.store != None:
+                    size, digest, md5, sha1 = self._store(src)
+                else:
+                    try:
+                        os.makedirs(os.path.dirname(dst))
+                    except OSError as exc:
+                        if exc.errno != errno.EEXIST:
+                            raise
+                    # copy under a temporary name so an interrupted copy never
+                    # sits at dst without a journal entry
+                    self.copier(src, dst + ".part")
+                    os.rename(dst + ".part", dst)
+                    size = os.path.getsize(dst)
+                with self.lock:
+                    if self.store != None:
+                        manifest.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(digest, md5, sha1, size, src, dst))
+                        manifest.flush()
+                        journal.write("{0}\t{1}\t{2}\t{3}\n".format(src, dst, size, digest))
+                    else:
+                        journal.write("{0}\t{1}\t{2}\n".format(src, dst, size))
+                    journal.flush()
+                    self.files += 1
+                    self.bytes += size
+                    print "Copied " + src + " to " + dst
+            except (IOError, OSError), e:
+                if self.store == None and os.path.exists(dst + ".part"):
+                    os.remove(dst + ".part")
+                with self.lock:
+                    self.errors.append((src, dst, str(e)))
+                    print "ERROR copying " + src + " to " + dst
+
+    def run(self):
+        jobs = Queue.Queue()
+        for job in self.jobs:
+            jobs.put(job)
+        journal = open(self.journalname, "a")
+        manifest = None
+        if self.store != None:
+            try:
+                os.makedirs(self.store)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            manifest = open(self.manifestname, "a")
+        start = time.time()
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target = self._worker, args = (jobs, journal, manifest))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # join with a timeout so Ctrl-C still reaches the main thread
+            while t.is_alive():
+                t.join(1)
+        journal.close()
+        if manifest != None:
+            manifest.close()
+        self.jobs = []
+        elapsed = max(time.time() - start, 0.001)
+        print "Copied {0} files ({1} bytes) in {2:.2f}s: {3:.1f} files/sec, {4:.1f} MB/sec".format(
+                self.files, self.bytes, elapsed, self.files / elapsed, self.bytes / elapsed / (1024 * 1024))
+        if self.store != None:
+            print "{0} files ({1} bytes) were duplicates of files already stored".format(self.duplicates, self.dupbytes)
+        if len(self.resumed) > 0:
+            print "Skipped {0} files already in the journal".format(len(self.resumed))
+        for src, dst, err in self.errors:
+            print "ERROR copying {0} to {1}: {2}".format(src, dst, err)
+
+def _kernel_copy(fin, fout, offset, count):
+    '''
+    Copies count bytes at offset from fin to fout without going through
+    user space.  Returns the number of bytes copied, or None if neither
+    copy_file_range nor sendfile can be used for these files
+    '''
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(fin, fout, count, offset, offset)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    elif libc != None and hasattr(libc, "copy_file_range"):
+        offin = ctypes.c_longlong(offset)
+        offout = ctypes.c_longlong(offset)
+        n = libc.copy_file_range(fin, ctypes.byref(offin), fout, ctypes.byref(offout), count, 0)
+        if n >= 0:
+            return n
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+            raise OSError(err, os.strerror(err))
+    # sendfile writes at the current position of fout
+    os.lseek(fout, offset, os.SEEK_SET)
+    if hasattr(os, "sendfile"):
+        try:
+            return os.sendfile(fout, fin, offset, count)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+    elif libc != None and hasattr(libc, "sendfile"):
+        offin = ctypes.c_longlong(offset)
+        n = libc.sendfile(fout, fin, ctypes.byref(offin), count)
+        if n >= 0:
+            return n
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err))
+    return None
+
+def _extents(fin, size):
+    '''
+    Yields (offset, length) of the data regions of fin, the whole file if
+    the filesystem can't report holes
+    '''
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fin, offset, SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                # nothing but a hole up to the end of the file
+                return
+            if offset == 0:
+                yield 0, size
+                return
+            raise
+        end = os.lseek(fin, start, SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+def ZeroCopy(src, dst):
+    '''
+    Drop in replacement for shutil.copy2 that copies the data regions of src
+    in the kernel and leaves holes as holes, falling back to read/write for
+    anything the kernel won't do.  Just shutil.copy2 on anything but Linux
+    '''
+    if not linux:
+        shutil.copy2(src, dst)
+        return
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            size = os.fstat(fin).st_size
+            kernel = True
+            for start, length in _extents(fin, size):
+                offset = start
+                while offset < start + length:
+                    count = min(CHUNK, start + length - offset)
+                    n = None
+                    if kernel:
+                        n = _kernel_copy(fin, fout, offset, count)
+                        if n == None:
+                            kernel = False
+                    if n == None:
+                        os.lseek(fin, offset, os.SEEK_SET)
+                        os.lseek(fout, offset, os.SEEK_SET)
+                        n = os.write(fout, os.read(fin, min(count, 1024 * 1024)))
+                    if n == 0:
+                        # file shrank while we were copying it
+                        break
+                    offset += n
+            # a trailing hole has no data to copy, so set the size explicitly
+            os.ftruncate(fout, size)
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+    shutil.copystat(src, dst)
+
 def rreplace(s, old, new, occurrence):
     li = s.rsplit(old, occurrence)
     return new.join(li)
 
-def GetAvailable(dst, fname):
+def GetAvailable(dst, fname, engine):
     '''
     Since some modules are listed without full paths, we'll try to find
     and available file name.  Hopefully there aren't any more than 20 
     modules with the same name... nah...
     '''
-    if os.path.exists(os.path.join(dst, fname)):
+    if engine.taken(os.path.join(dst, fname)):
         for i in range(1, 20):
-            if not os.path.exists(os.path.join(dst, fname + "." + str(i))):
+            if not engine.taken(os.path.join(dst, fname + "." + str(i))):
                 return fname + "." + str(i)
         return fname + ".past_threshold"
     else:
         return fname
 
-def ProcessPathlessFiles(src, dst, files):
-    subdirlist = []
-    os.chdir(src)
-    for fname in os.listdir(src):
-        if fname.lower() in files and os.path.isfile(os.path.join(src, fname)):
-            thefile = os.path.join(src, fname)
-            print "Copying " + thefile + " to " + dst
-            dstfile = GetAvailable(dst, fname) 
-            shutil.copy2(thefile, os.path.join(dst, dstfile))
-        elif os.path.isdir(os.path.join(src, fname)):
-            subdirlist.append(os.path.join(src, fname))
-    for subdir in subdirlist:
-        ProcessPathlessFiles(subdir, dst, files)
+def ScanDir(src):
+    '''
+    Yields (name, path, is file, is dir) for each entry in src
+    '''
+    if scandir != None:
+        for entry in scandir(src):
+            yield entry.name, entry.path, entry.is_file(), entry.is_dir()
+    else:
+        for fname in os.listdir(src):
+            path = os.path.join(src, fname)
+            isfile = os.path.isfile(path)
+            yield fname, path, isfile, not isfile and os.path.isdir(path)
+
+def BuildIndex(src):
+    '''
+    Walks src once and returns a {lowercase file name: [paths]} index
+    '''
+    index = {}
+    dirs = [src]
+    while dirs:
+        subdirlist = []
+        for fname, path, isfile, isdir in ScanDir(dirs.pop(0)):
+            if isfile:
+                index.setdefault(fname.lower(), []).append(path)
+            elif isdir:
+                subdirlist.append(path)
+        # keep the original order: files of a directory, then its subdirectories
+        dirs[0:0] = subdirlist
+    return index
+
+def LoadIndex(src, cache = None):
+    '''
+    Returns the filename index for src, from cache if it was built for the
+    same source, otherwise walks src and saves the index to cache
+    '''
+    src = os.path.abspath(src)
+    if cache != None and os.path.isfile(cache):
+        f = open(cache, "rb")
+        try:
+            root, index = marshal.load(f)
+        finally:
+            f.close()
+        if root == src:
+            return index
+    index = BuildIndex(src)
+    if cache != None:
+        f = open(cache + ".tmp", "wb")
+        try:
+            marshal.dump((src, index), f)
+        finally:
+            f.close()
+        os.rename(cache + ".tmp", cache)
+    return index
 
-def GetSelectTypeFiles(src, dst):
+def ProcessPathlessFiles(index, dst, files, engine):
+    # a name listed more than once (or in another case) is only looked up once
+    names = []
+    seen = set()
+    for fname in files:
+        if fname.lower() not in seen:
+            seen.add(fname.lower())
+            names.append(fname.lower())
+    for fname in names:
+        for thefile in index.get(fname, []):
+            if not engine.copied(thefile, dst):
+                dstfile = GetAvailable(dst, os.path.basename(thefile), engine)
+                engine.add(thefile, os.path.join(dst, dstfile))
+
+def GetSelectTypeFiles(src, dst, engine):
     subdirlist = []
-    os.chdir(src)
     for fname in os.listdir(src):
         if os.path.isfile(os.path.join(src, fname)) and os.path.splitext(fname.lower())[1] in allowable:
             thefile = os.path.join(src, fname)
-            print "Copying " + thefile + " to " + dst 
-            dstfile = GetAvailable(dst, fname) 
-            shutil.copy2(thefile, os.path.join(dst, dstfile))
+            if not engine.copied(thefile, dst):
+                dstfile = GetAvailable(dst, fname, engine)
+                engine.add(thefile, os.path.join(dst, dstfile))
         elif os.path.isdir(os.path.join(src, fname)):
             subdirlist.append(os.path.join(src, fname))
     for subdir in subdirlist:
-        ProcessPathlessFiles(subdir, dst, files)
+        GetSelectTypeFiles(subdir, os.path.join(dst, os.path.basename(subdir)), engine)
+
+def GetAllFiles(src, dst, engine):
+    for root, dirs, files in os.walk(src):
+        for fname in files:
+            thefile = os.path.join(root, fname)
+            engine.add(thefile, os.path.join(dst, os.path.relpath(thefile, src)))
 
 def main():    
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "has:t:f:d:", ["help", "allfiles", "source=", "target=", "files=", "driverloc="])
+        opts, args = getopt.getopt(sys.argv[1:], "has:t:f:d:w:j:i:cz", ["help", "allfiles", "source=", "target=", "files=", "driverloc=", "workers=", "journal=", "index=", "cas", "zerocopy"])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
@@ -89,6 +493,11 @@ def main():
     files = None
     drivers = None
     all = False 
+    workers = 8
+    journal = None
+    indexfile = None
+    cas = False
+    copier = shutil.copy2
 
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -104,6 +513,16 @@ def main():
             drivers = a
         elif o in ("-a", "--allfiles"):
             all = True
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-j", "--journal"):
+            journal = a
+        elif o in ("-i", "--index"):
+            indexfile = a
+        elif o in ("-c", "--cas"):
+            cas = True
+        elif o in ("-z", "--zerocopy"):
+            copier = ZeroCopy
         else:
             assert False, "unhandled option\n\n"
             return
@@ -113,45 +532,42 @@ def main():
         usage()
         return
 
+    try:
+        os.makedirs(target)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    if journal == None:
+        journal = os.path.join(target, "collect.journal")
+    if cas:
+        engine = CopyEngine(journal, workers = workers, store = os.path.join(target, "blobs"),
+                manifest = os.path.join(target, "manifest.txt"))
+    else:
+        engine = CopyEngine(journal, workers = workers, copier = copier)
+
     f = open(files, "r")
     items = []
     for line in f.readlines():
         l = line.replace("\n", "")
         src = source + "/" + l
-        print src, target + "/" + l
         if all and os.path.isdir(src):
-            try:
-                shutil.copytree(src, target + "/" + l)
-                print "Copied " + src + " to " + target 
-            except OSError:
-                print "Target directory must be empty!"
-                return
+            GetAllFiles(src, target + "/" + l, engine)
         elif os.path.isdir(src):
-            GetSelectTypeFiles(src, dst)        
+            GetSelectTypeFiles(src, target + "/" + l, engine)
         elif os.path.isfile(src):
-            thefile = l.split("/")[-1]
-            thepath = target + "/" +  rreplace(l, thefile, '', 1)
-            try:
-                os.makedirs(thepath)
-            except OSError as exc: 
-                if exc.errno == errno.EEXIST:
-                    pass
-                else: raise
-            try:
-                shutil.copy2(src, target + "/" + l)
-                print "Copied file " + src + " to " + target
-            except : #OSError:
-                print "ERROR copying " + src + " to " + target + "/" + l
-                return
+            engine.add(src, target + "/" + l)
         else:
             items.append(l)
+    f.close()
 
     if len(items) > 0:
         if drivers != None:
             if os.path.isdir(drivers):
                 source = drivers
-        os.mkdir(target + "/drivers")
-        ProcessPathlessFiles(source, target + "/drivers", items)
+        index = LoadIndex(source, indexfile)
+        ProcessPathlessFiles(index, target + "/drivers", items, engine)
+
+    engine.run()
 
 if __name__ == "__main__":
     main()
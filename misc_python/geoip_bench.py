@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import getopt, sys, os
+import random
+import time
+
+try:
+    from pygeoip import *
+except ImportError:
+    print "You must install pygeoip:\n\t https://github.com/appliedsec/pygeoip\n"
+    sys.exit(2)
+
+from getIPInfo import GeoLookup
+
+'''
+Author: Gleeda <jamie.levy@gmail.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version
+2 of the License, or (at your option) any later version.
+
+geoip_bench.py
+
+Times GeoIP lookups over an IP log the way getIPInfo.py used to do them
+(one lookup per line, database read from disk) against the deduplicated
+bulk lookups with the mmap and in-memory database modes.  Without -f a
+synthetic log is generated from a fixed seed.
+
+ -g <GeoLiteCity.dat file>
+ -f <IP log, one address per line (default synthetic)>
+ -n <number of lines in the synthetic log (default 1000000)>
+ -u <number of distinct addresses in the synthetic log (default 50000)>
+'''
+
+def usage():
+    print sys.argv[0], "\n"
+    print " -g <GeoLiteCity.dat file>"
+    print " -f <IP log, one address per line (default synthetic)>"
+    print " -n <number of lines in the synthetic log (default 1000000)>"
+    print " -u <number of distinct addresses in the synthetic log (default 50000)>"
+
+def synthetic(lines, distinct, seed = 1):
+    r = random.Random(seed)
+    ips = []
+    for i in xrange(distinct):
+        # addresses clustered in a few thousand /16s, like a real log
+        ips.append("{0}.{1}.{2}.{3}".format(r.randint(1, 223), r.randint(0, 15), r.randint(0, 255), r.randint(1, 254)))
+    # a few addresses make up most of the lines
+    return [ips[min(int(r.paretovariate(1.2)) - 1, distinct - 1)] if r.random() < 0.8 else r.choice(ips) for i in xrange(lines)]
+
+def opengeoip(filename, flags):
+    # pygeoip keeps one instance per file name unless told otherwise
+    try:
+        return GeoIP(filename, flags, cache = False)
+    except TypeError:
+        return GeoIP(filename, flags)
+
+def timeit(name, func, lines):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print "{0:45} {1:8.2f}s {2:12.0f} lines/sec".format(name, elapsed, lines / elapsed)
+
+def main():
+    GeoLite = None
+    ipfile = None
+    lines = 1000000
+    distinct = 50000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hg:f:n:u:", ["help", "geolitecity=", "file=", "lines=", "unique="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-g", "--geolitecity"):
+            GeoLite = a
+        elif o in ("-f", "--file"):
+            ipfile = a
+        elif o in ("-n", "--lines"):
+            lines = int(a)
+        elif o in ("-u", "--unique"):
+            distinct = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(-2)
+
+    if GeoLite == None:
+        usage()
+        sys.exit(2)
+
+    if ipfile != None:
+        f = open(ipfile, "r")
+        ips = [i.strip() for i in f]
+        f.close()
+    else:
+        ips = synthetic(lines, distinct)
+    print "{0} lines, {1} distinct addresses\n".format(len(ips), len(set(ips)))
+
+    gi = opengeoip(GeoLite, STANDARD)
+    def perline():
+        for ip in ips:
+            gi.record_by_addr(ip)
+    timeit("per line, standard", perline, len(ips))
+    for name, flags in [("standard", STANDARD), ("mmap", MMAP_CACHE), ("memory", MEMORY_CACHE)]:
+        gi = opengeoip(GeoLite, flags)
+        timeit("deduplicated, " + name, lambda: GeoLookup(gi, ips), len(ips))
+        timeit("deduplicated, sorted, " + name, lambda: GeoLookup(gi, ips, sort = True), len(ips))
+
+if __name__ == "__main__":
+    main()
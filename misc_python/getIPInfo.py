@@ -1,7 +1,22 @@
 #!/usr/bin/env python
 import socket
 import getopt, sys, os
+import select
+import random
+import time
+import collections
+import sqlite3
+import json
+import struct
+import bisect
+import csv
+import threading
+import Queue
+import traceback
 import dns.resolver
+import dns.message
+import dns.rdatatype
+import dns.rcode
 
 try:
     from pygeoip import *
@@ -20,6 +35,24 @@ try:
 except ImportError:
     has_openpyxl = False
 
+# styled cells for write-only (streamed) worksheets, moved around between openpyxl versions
+try:
+    from openpyxl.cell import WriteOnlyCell
+    has_writeonlycell = True
+except ImportError:
+    try:
+        from openpyxl.writer.write_only import WriteOnlyCell
+        has_writeonlycell = True
+    except ImportError:
+        has_writeonlycell = False
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    has_pyarrow = True
+except ImportError:
+    has_pyarrow = False
+
 
 '''
 Author: Gleeda <jamie.levy@gmail.com>
@@ -35,6 +68,19 @@ getIPInfo.py
  -e <excel output file (default csv to stdout)>
  -g <GeoLiteCity.dat file>
  -c [optional: this will add color to excel file]
+ -a [optional: check blacklists for all IPs concurrently]
+ -n <nameserver[:port] for -a (default from resolv.conf)>
+ -q <maximum queries in flight for -a (default 200)>
+ -r <maximum queries per second to each blacklist for -a (default 50)>
+ -k <lookup cache file, reused across runs>
+ -s <maximum number of entries in the lookup cache (default 1000000)>
+ -m <GeoIP database access: standard (read from disk), mmap or memory (default standard)>
+ -o [optional: look up unique addresses in address order]
+ -b [optional: one GeoIP lookup per network block, stop blacklist lookups for an IP
+     once it is listed, and add a per block summary]
+ -w <csv or parquet output file, picked by extension (.csv/.parquet)>
+ -p <blacklist threads: stream the file through a lookup pipeline and report
+     per stage throughput and queue depth to stderr (-o is ignored)>
 
 What you need:
     1) File with IP addresses, one per line
@@ -46,6 +92,15 @@ What you need:
 
 robtex = "https://www.robtex.com/en/advisory/ip"
 
+geoipmodes = {
+    "standard": STANDARD,
+    "mmap": MMAP_CACHE,
+    "memory": MEMORY_CACHE,
+}
+
+# checkbl doesn't see DNS TTLs, so its verdicts are cached for this long (seconds)
+DNSBL_TTL = 3600
+
 codes = {
     "127.0.0.2": "Direct UBE sources, spam operations & spam services",
     "127.0.0.3": "Direct snowshoe spam sources detected via automation",
@@ -150,9 +205,9 @@ if has_openpyxl:
             #        fill_type = "solid"))
 
 def checkbl(ip):
+    my_resolver = dns.resolver.Resolver()
     for server in servers:
         try:
-            my_resolver = dns.resolver.Resolver()
             query = ip + '.' + server
             res = socket.gethostbyname(query)
             answer_txt = "{0}".format(my_resolver.query(query, "TXT")[0] or "")
@@ -161,23 +216,786 @@ def checkbl(ip):
             pass
     return ["", "", "", ""]
 
+class DNSBLChecker:
+    '''
+    Checks many IPs against the blacklists at once.  Queries go out over one
+    non-blocking UDP socket and answers are matched up by DNS message id, so
+    hundreds of lookups can be waiting on the network at the same time.
+    inflight caps the number of outstanding queries and rate caps the
+    queries per second sent to each blacklist, across all the calls made
+    on the checker.  rate can be below 1.  Point nameserver/port at a stub
+    server to test without touching the real blacklists.
+    '''
+    def __init__(self, nameserver = None, port = 53, inflight = 200, rate = 50, timeout = 2.0, retries = 2):
+        if nameserver == None:
+            nameserver = dns.resolver.get_default_resolver().nameservers[0]
+        if rate <= 0:
+            raise ValueError("rate has to be more than 0 queries per second")
+        self.address = (nameserver, port)
+        self.inflight = inflight
+        self.rate = rate
+        self.timeout = timeout
+        self.retries = retries
+        # token bucket per zone, holding at least one token so rates below 1 qps still refill
+        self.burst = max(rate, 1)
+        self.tokens = {}
+        self.last = {}
+        # queries waiting on an answer, over every resolve() running on the checker
+        self.sending = 0
+        self.lock = threading.Lock()
+
+    def _take(self, zone):
+        '''
+        Takes an in-flight slot and a token from the bucket of zone for one
+        query.  None if all the slots are taken, False if there is no token yet
+        '''
+        with self.lock:
+            if self.sending >= self.inflight:
+                return None
+            now = time.time()
+            tokens = min(self.burst, self.tokens.get(zone, self.burst) + (now - self.last.get(zone, now)) * self.rate)
+            self.last[zone] = now
+            if tokens < 1:
+                self.tokens[zone] = tokens
+                return False
+            self.tokens[zone] = tokens - 1
+            self.sending += 1
+            return True
+
+    def _release(self, n = 1):
+        with self.lock:
+            self.sending -= n
+
+    def resolve(self, queries):
+        '''
+        queries is a list of (zone, qname, rdtype).  Returns {(qname, rdtype): (answers, ttl)},
+        answers is None for NXDOMAIN, errors and timeouts.  zone is only used for rate limiting
+        '''
+        # the servers list has duplicates, only ask once
+        seen = set()
+        pending = collections.deque()
+        for query in queries:
+            if (query[1], query[2]) not in seen:
+                seen.add((query[1], query[2]))
+                pending.append(query)
+        results = {}
+        outstanding = {}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        try:
+            while pending or outstanding:
+                now = time.time()
+                for i in xrange(len(pending)):
+                    zone, qname, rdtype = pending[0]
+                    taken = self._take(zone)
+                    if taken == None:
+                        break
+                    if not taken:
+                        # rate limited, look at the next query and come back to this one
+                        pending.rotate(-1)
+                        continue
+                    pending.popleft()
+                    self._send(sock, outstanding, zone, qname, rdtype, 0)
+
+                deadline = min([q[4] for q in outstanding.values()] + [now + 0.05])
+                readable = select.select([sock], [], [], max(0, min(deadline - now, 0.05)))[0]
+                while readable:
+                    try:
+                        data = sock.recv(65535)
+                    except socket.error:
+                        break
+                    try:
+                        response = dns.message.from_wire(data)
+                    except Exception:
+                        continue
+                    # replies without a question section can't be matched to a query
+                    query = outstanding.get(response.id)
+                    if query == None or not response.question or response.question[0].name != query[5].question[0].name:
+                        continue
+                    del outstanding[response.id]
+                    self._release()
+                    results[(query[1], query[2])] = self._answers(response, query[2])
+
+                now = time.time()
+                for id, query in outstanding.items():
+                    if query[4] <= now:
+                        del outstanding[id]
+                        if query[3] < self.retries:
+                            self._send(sock, outstanding, query[0], query[1], query[2], query[3] + 1)
+                        else:
+                            self._release()
+                            results[(query[1], query[2])] = (None, 0)
+        finally:
+            # give back the slots of queries still out if we were interrupted
+            self._release(len(outstanding))
+            sock.close()
+        return results
+
+    def _send(self, sock, outstanding, zone, qname, rdtype, tries):
+        msg = dns.message.make_query(qname, rdtype)
+        while msg.id in outstanding:
+            msg.id = random.randint(0, 65535)
+        outstanding[msg.id] = (zone, qname, rdtype, tries, time.time() + self.timeout, msg)
+        try:
+            sock.sendto(msg.to_wire(), self.address)
+        except socket.error:
+            # treated like a lost packet, it times out and is retried
+            pass
+
+    def _answers(self, response, rdtype):
+        answers = []
+        ttl = None
+        if response.rcode() == dns.rcode.NOERROR:
+            for rrset in response.answer:
+                if rrset.rdtype != rdtype:
+                    continue
+                ttl = rrset.ttl if ttl == None else min(ttl, rrset.ttl)
+                for rd in rrset:
+                    if rdtype == dns.rdatatype.A:
+                        answers.append(rd.address)
+                    else:
+                        answers.append("".join(rd.strings))
+        if answers:
+            return (answers, ttl)
+        if response.rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            # negative answers are good for the SOA minimum (RFC 2308)
+            for rrset in response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return (None, min(rrset.ttl, rrset[0].minimum))
+        return (None, 0)
+
+    def check(self, ips, shortcircuit = False, ttls = None):
+        '''
+        Returns {ip: checkbl style result} for a list of dotted quad IPs.  All
+        blacklist A queries are sent together, then TXT queries for the
+        first blacklist (in servers order) each listed IP was found on.
+        With shortcircuit the blacklists are asked one after the other and
+        IPs that are already listed are left out of the later rounds.
+        self.ttls is set to {ip: seconds the result is good for}, 0 if any
+        of the lookups behind it failed.  Threads sharing the checker pass
+        their own ttls dict to be filled in instead
+        '''
+        revs = dict((ip, '.'.join(ip.split('.')[::-1])) for ip in ips)
+        if shortcircuit:
+            answers = {}
+            remaining = ips
+            for server in servers:
+                if not remaining:
+                    break
+                answers.update(self.resolve([(server, revs[ip] + '.' + server, dns.rdatatype.A) for ip in remaining]))
+                remaining = [ip for ip in remaining if answers[(revs[ip] + '.' + server, dns.rdatatype.A)][0] == None]
+        else:
+            queries = []
+            for ip in ips:
+                for server in servers:
+                    queries.append((server, revs[ip] + '.' + server, dns.rdatatype.A))
+            answers = self.resolve(queries)
+
+        listed = {}
+        if ttls == None:
+            ttls = self.ttls = {}
+        for ip in ips:
+            lifetimes = []
+            for server in servers:
+                res = answers.get((revs[ip] + '.' + server, dns.rdatatype.A))
+                lifetimes.append(res[1])
+                if res[0] != None:
+                    listed[ip] = (server, res[0][0])
+                    break
+            ttls[ip] = min(lifetimes)
+        txts = self.resolve([(server, revs[ip] + '.' + server, dns.rdatatype.TXT) for ip, (server, res) in listed.items()])
+
+        results = {}
+        for ip in ips:
+            if ip not in listed:
+                results[ip] = ["", "", "", ""]
+                continue
+            server, res = listed[ip]
+            txt = txts.get((revs[ip] + '.' + server, dns.rdatatype.TXT))
+            answer_txt = txt[0][0] if txt[0] != None else ""
+            ttls[ip] = min(ttls[ip], txt[1])
+            results[ip] = ["Yes", codes.get(res, res), server, answer_txt]
+        return results
+
+class LookupCache:
+    '''
+    sqlite cache of lookup results keyed by IP and lookup source.  Entries
+    carry an expiry (the DNS TTL for blacklist verdicts, none for GeoIP)
+    and a version (the GeoIP database version) and are only returned while
+    both are still good.  Inserts are committed every batch puts and on
+    close, and each commit drops the least recently used entries past
+    maxentries, so an interrupted run keeps what it already looked up.
+    '''
+    def __init__(self, filename, maxentries = 1000000, batch = 1000):
+        self.maxentries = maxentries
+        self.batch = batch
+        self.pending = 0
+        self.hits = {}
+        self.misses = {}
+        # shared by the -p pipeline threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread = False)
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS lookups (
+                ip          TEXT,
+                source      TEXT,
+                value       TEXT,
+                expires     REAL,
+                version     TEXT,
+                used        REAL,
+                PRIMARY KEY (ip, source)
+            );
+        CREATE INDEX IF NOT EXISTS lookups_used ON lookups(used);
+        ''')
+
+    def get(self, ip, source, version = ""):
+        with self.lock:
+            return self._get(ip, source, version)
+
+    def _get(self, ip, source, version):
+        now = time.time()
+        row = self.conn.execute("SELECT value, expires, version FROM lookups WHERE ip = ? AND source = ?", (ip, source)).fetchone()
+        if row == None or (row[1] != None and row[1] <= now) or row[2] != version:
+            self.misses[source] = self.misses.get(source, 0) + 1
+            return None
+        self.hits[source] = self.hits.get(source, 0) + 1
+        self.conn.execute("UPDATE lookups SET used = ? WHERE ip = ? AND source = ?", (now, ip, source))
+        return json.loads(row[0])
+
+    def put(self, ip, source, value, ttl = None, version = ""):
+        # a ttl of 0 means the lookup failed somewhere, so don't keep it
+        if ttl != None and ttl <= 0:
+            return
+        now = time.time()
+        expires = now + ttl if ttl != None else None
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO lookups VALUES(?, ?, ?, ?, ?, ?)",
+                    (ip, source, json.dumps(value), expires, version, now))
+            self.pending += 1
+            if self.pending >= self.batch:
+                self._commit()
+
+    def _commit(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM lookups").fetchone()[0]
+        if count > self.maxentries:
+            self.conn.execute("DELETE FROM lookups WHERE rowid IN (SELECT rowid FROM lookups ORDER BY used LIMIT ?)",
+                    (count - self.maxentries,))
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+    def stats(self):
+        lines = []
+        for source in sorted(set(self.hits.keys() + self.misses.keys())):
+            lines.append("{0}: {1} hits, {2} misses".format(source, self.hits.get(source, 0), self.misses.get(source, 0)))
+        return "\n".join(lines)
+
+def ip2long(ip):
+    try:
+        return struct.unpack("!L", socket.inet_aton(ip))[0]
+    except socket.error:
+        return -1
+
+def GeoLookup(gi, ips, sort = False):
+    '''
+    Looks up each distinct address in ips once and returns {ip: record}.
+    Sorting by address means consecutive lookups walk mostly the same
+    part of the database tree, which helps with mmap and disk reads
+    '''
+    unique = set(ips)
+    if sort:
+        unique = sorted(unique, key = ip2long)
+    results = {}
+    for ip in unique:
+        results[ip] = gi.record_by_addr(ip) or {"country_code": "", "country_name": ""}
+    return results
+
+def long2ip(n):
+    return socket.inet_ntoa(struct.pack("!L", n))
+
+class RangeIndex:
+    '''
+    Non-overlapping [start, end] address ranges kept sorted by start, so the
+    range holding an address is found with a binary search
+    '''
+    def __init__(self):
+        self.starts = []
+        self.ranges = []
+
+    def find(self, n):
+        i = bisect.bisect_right(self.starts, n) - 1
+        if i >= 0 and self.ranges[i][1] >= n:
+            return self.ranges[i]
+        return None
+
+    def add(self, start, end, value):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ranges.insert(i, (start, end, value))
+        return self.ranges[i]
+
+class GeoBlocks:
+    '''
+    Uses the netmask the database reports for each lookup so every other
+    address in the same block is answered from a RangeIndex instead of the
+    database.  Each record gets a "network" key with the block in CIDR
+    notation
+    '''
+    def __init__(self, gi):
+        self.gi = gi
+        self.index = RangeIndex()
+
+    def lookup(self, ip):
+        n = ip2long(ip)
+        block = self.index.find(n) if n >= 0 else None
+        if block != None:
+            return block[2]
+        record = dict(self.gi.record_by_addr(ip) or {"country_code": "", "country_name": ""})
+        if n < 0:
+            record["network"] = ip
+            return record
+        mask = 32
+        if hasattr(self.gi, "last_netmask"):
+            mask = self.gi.last_netmask() or 32
+        start = n & (0xFFFFFFFF << (32 - mask)) & 0xFFFFFFFF
+        record["network"] = "{0}/{1}".format(long2ip(start), mask)
+        return self.index.add(start, start + (1 << (32 - mask)) - 1, record)[2]
+
+def GeoBlockLookup(gi, ips):
+    # like GeoLookup, but one database lookup per network block
+    blocks = GeoBlocks(gi)
+    results = {}
+    for ip in sorted(set(ips), key = ip2long):
+        results[ip] = blocks.lookup(ip)
+    return results
+
+class BlockSummary:
+    # per network block counts for -b
+    header = ["Network", "Country Code", "Country Name", "Addresses", "Lines", "Blacklisted Addresses"]
+
+    def __init__(self):
+        self.networks = {}
+
+    def add(self, item, gistuff, verdict):
+        network = gistuff["network"]
+        if network not in self.networks:
+            self.networks[network] = [network, gistuff["country_code"], gistuff["country_name"], set(), 0, set()]
+        self.networks[network][3].add(item)
+        self.networks[network][4] += 1
+        if verdict == "Yes":
+            self.networks[network][5].add(item)
+
+    def rows(self):
+        rows = []
+        for network in sorted(self.networks.keys(), key = lambda x: ip2long(x.split("/")[0])):
+            row = self.networks[network]
+            rows.append([row[0], row[1], row[2], str(len(row[3])), str(row[4]), str(len(row[5]))])
+        return rows
+
+def GeoIPVersion(filename):
+    '''
+    Legacy GeoIP databases end with an info string (e.g. "GEO-533LITE 20140107
+    Build 1") after three zero bytes.  Falls back to size and mtime
+    '''
+    f = open(filename, "rb")
+    try:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 200))
+        tail = f.read()
+    finally:
+        f.close()
+    start = tail.rfind("\x00\x00\x00")
+    if start != -1:
+        info = tail[start + 3:start + 103].split("\x00")[0]
+        if info != "" and all(32 <= ord(c) < 127 for c in info):
+            return info
+    return "{0}-{1}".format(size, int(os.path.getmtime(filename)))
+
+class TextOutput:
+    # the original output: comma joined lines on stdout
+    def __init__(self, header):
+        print ",".join(x for x in header)
+
+    def append(self, line):
+        print ",".join(x for x in line)
+
+    def summary(self, header, rows):
+        print
+        print ",".join(header)
+        for row in rows:
+            print ",".join(row)
+
+    def close(self):
+        pass
+
+class CSVOutput:
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.f = open(filename, "wb")
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(header)
+
+    def append(self, line):
+        self.writer.writerow(line)
+
+    def summary(self, header, rows):
+        f = open(os.path.splitext(self.filename)[0] + ".summary.csv", "wb")
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+        f.close()
+
+    def close(self):
+        self.f.close()
+
+class ParquetOutput:
+    '''
+    Buffers rows a row group at a time, so memory doesn't grow with the
+    number of rows.  All columns are strings
+    '''
+    def __init__(self, filename, header, rowgroup = 65536):
+        self.filename = filename
+        self.header = header
+        self.rowgroup = rowgroup
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in header])
+        self.writer = None
+        self.columns = [[] for x in header]
+
+    def _flush(self):
+        if len(self.columns[0]) == 0:
+            return
+        table = pyarrow.Table.from_arrays([pyarrow.array(c, type = pyarrow.string()) for c in self.columns], schema = self.schema)
+        if self.writer == None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        self.writer.write_table(table)
+        self.columns = [[] for x in self.header]
+
+    def append(self, line):
+        for column, value in zip(self.columns, line):
+            column.append(value)
+        if len(self.columns[0]) >= self.rowgroup:
+            self._flush()
+
+    def summary(self, header, rows):
+        columns = [list(c) for c in zip(*rows)] if rows else [[] for x in header]
+        table = pyarrow.Table.from_arrays([pyarrow.array(c, type = pyarrow.string()) for c in columns], names = header)
+        pyarrow.parquet.write_table(table, os.path.splitext(self.filename)[0] + ".summary.parquet")
+
+    def close(self):
+        self._flush()
+        if self.writer == None:
+            # no rows, still leave a file with the columns like the other outputs
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        self.writer.close()
+
+def StyledCell(ws, value, style):
+    cell = WriteOnlyCell(ws, value = value)
+    cell.font = style.font
+    cell.fill = style.fill
+    cell.border = style.border
+    return cell
+
+class XlsxOutput:
+    '''
+    Streams rows into a write-only workbook.  With color the Red/Green/Bold
+    styles are put on the cells as they are written, so the workbook never
+    has to be loaded back in to be colored
+    '''
+    def __init__(self, filename, header, color = False):
+        self.filename = filename
+        self.color = color
+        self.header = header
+        self.total = 1
+        try:
+            self.wb = Workbook(write_only = True)
+        except TypeError:
+            # openpyxl before 2.2
+            self.wb = Workbook(optimized_write = True)
+        self.ws = self.wb.create_sheet()
+        self.ws.title = "IP Address Info"
+        self.ws.append(self._row(self.ws, header, BoldStyle))
+
+    def _row(self, ws, line, style):
+        if not self.color or not has_writeonlycell:
+            return line
+        return [StyledCell(ws, value, style) for value in line]
+
+    def append(self, line):
+        self.ws.append(self._row(self.ws, line, RedStyle if line[3] == "Yes" else GreenStyle))
+        self.total += 1
+
+    def summary(self, header, rows):
+        ws = self.wb.create_sheet()
+        ws.title = "Network Summary"
+        ws.append(self._row(ws, header, BoldStyle))
+        for row in rows:
+            ws.append(row)
+
+    def close(self):
+        self.wb.save(filename = self.filename)
+        if not self.color or has_writeonlycell:
+            return
+        # this openpyxl can't style cells in a write-only sheet, so load and style it
+        wb = load_workbook(filename = self.filename)
+        ws = wb.get_sheet_by_name(name = "IP Address Info")
+        for col in xrange(1, len(self.header) + 1):
+            ws.cell("{0}{1}".format(get_column_letter(col), 1)).style = BoldStyle
+
+        for row in xrange(2, self.total + 1):
+            for col in xrange(1, len(self.header) + 1):
+                if ws.cell("{0}{1}".format(get_column_letter(4), row)).value == "Yes":
+                    ws.cell("{0}{1}".format(get_column_letter(col), row)).style = RedStyle
+                else:
+                    ws.cell("{0}{1}".format(get_column_letter(col), row)).style = GreenStyle
+        wb.save(filename = self.filename)
+
+class Pipeline:
+    '''
+    Streams the IP file through a chain of stages joined by bounded queues:
+    a reader that pulls lines lazily, a dedup stage that passes on each
+    address the first time it shows up, a GeoIP stage, a pool of blacklist
+    threads and a writer (the calling thread) that puts the lines back in
+    file order.  Lookups start while the file is still being read and only
+    the distinct addresses are held in memory.  With a DNSBLChecker each
+    blacklist thread hands whatever addresses are waiting to check() as
+    one batch.  Items, rate and input queue depth for each stage are
+    written to stderr at the end
+    '''
+    stages = ["reader", "dedup", "geoip", "dnsbl", "writer"]
+
+    def __init__(self, gi, out, cache = None, geoversion = "", blocks = False, checker = None, workers = 4, depth = 10000):
+        self.gi = gi
+        self.out = out
+        self.cache = cache
+        self.geoversion = geoversion
+        self.blocks = blocks
+        self.checker = checker
+        self.workers = workers
+        self.queues = {}
+        for stage in self.stages[1:-1]:
+            self.queues[stage] = Queue.Queue(depth)
+        # every line on its way to the writer, in file order
+        self.ordered = Queue.Queue(depth)
+        self.results = {}
+        self.done = threading.Condition()
+        self.failed = None
+        self.finished = False
+        self.counts = dict((stage, 0) for stage in self.stages)
+        self.times = {}
+        self.depths = dict((stage, [0, 0, 0]) for stage in self.stages[1:])
+
+    def _count(self, stage, n = 1):
+        now = time.time()
+        with self.done:
+            self.counts[stage] += n
+            if stage not in self.times:
+                self.times[stage] = [now, now]
+            self.times[stage][1] = now
+
+    def _run(self, stage, func, args, sentinels):
+        # a stage that dies still sends its sentinels so nothing downstream waits forever
+        try:
+            func(*args)
+        except Exception:
+            with self.done:
+                self.failed = (stage, traceback.format_exc())
+                self.done.notify_all()
+        for q, n in sentinels:
+            for i in xrange(n):
+                q.put(None)
+
+    def _reader(self, ipfile):
+        for line in ipfile:
+            self.queues["dedup"].put(line.strip())
+            self._count("reader")
+
+    def _dedup(self):
+        seen = set()
+        while True:
+            item = self.queues["dedup"].get()
+            if item == None:
+                break
+            self.ordered.put(item)
+            if item not in seen:
+                seen.add(item)
+                self.queues["geoip"].put(item)
+            self._count("dedup")
+
+    def _geoip(self):
+        geoblocks = GeoBlocks(self.gi) if self.blocks else None
+        while True:
+            item = self.queues["geoip"].get()
+            if item == None:
+                break
+            gistuff = None
+            if self.cache != None:
+                gistuff = self.cache.get(item, "geoip", self.geoversion)
+            if gistuff == None or (self.blocks and "network" not in gistuff):
+                if geoblocks != None:
+                    gistuff = geoblocks.lookup(item)
+                else:
+                    gistuff = self.gi.record_by_addr(item) or {"country_code": "", "country_name": ""}
+                if self.cache != None:
+                    value = {"country_code": gistuff["country_code"], "country_name": gistuff["country_name"]}
+                    if "network" in gistuff:
+                        value["network"] = gistuff["network"]
+                    self.cache.put(item, "geoip", value, version = self.geoversion)
+            with self.done:
+                self.results[item] = [gistuff, None]
+            self.queues["dnsbl"].put(item)
+            self._count("geoip")
+
+    def _dnsbl(self):
+        # the threads share one checker so its inflight and rate limits hold for all of them
+        checker = self.checker
+        while True:
+            batch = [self.queues["dnsbl"].get()]
+            if checker != None:
+                try:
+                    while batch[-1] != None and len(batch) < checker.inflight:
+                        batch.append(self.queues["dnsbl"].get_nowait())
+                except Queue.Empty:
+                    pass
+            last = batch[-1] == None
+            if last:
+                batch.pop()
+            found = {}
+            todo = []
+            for item in batch:
+                if self.cache != None:
+                    found[item] = self.cache.get(item, "dnsbl")
+                if found.get(item) == None:
+                    todo.append(item)
+            if checker != None and todo:
+                ttls = {}
+                found.update(checker.check(todo, shortcircuit = self.blocks, ttls = ttls))
+                if self.cache != None:
+                    for item in todo:
+                        self.cache.put(item, "dnsbl", found[item], ttls[item])
+            else:
+                for item in todo:
+                    found[item] = checkbl('.'.join(item.split('.')[::-1]))
+                    if self.cache != None:
+                        self.cache.put(item, "dnsbl", found[item], DNSBL_TTL)
+            with self.done:
+                for item in batch:
+                    self.results[item][1] = found[item]
+                self.done.notify_all()
+            if batch:
+                self._count("dnsbl", len(batch))
+            if last:
+                break
+
+    def _monitor(self):
+        while not self.finished:
+            for stage, q in self.queues.items() + [("writer", self.ordered)]:
+                size = q.qsize()
+                self.depths[stage][0] += size
+                self.depths[stage][1] += 1
+                self.depths[stage][2] = max(self.depths[stage][2], size)
+            time.sleep(0.1)
+
+    def _wait(self, item):
+        with self.done:
+            while self.results.get(item) == None or self.results[item][1] == None:
+                if self.failed != None:
+                    raise RuntimeError("{0} stage failed:\n{1}".format(*self.failed))
+                self.done.wait(0.5)
+            return self.results[item]
+
+    def run(self, ipfile):
+        '''
+        Writes a row to out for each line of ipfile and returns the
+        BlockSummary with -b, otherwise None
+        '''
+        summary = BlockSummary() if self.blocks else None
+        threads = [
+            threading.Thread(target = self._run, args = ("reader", self._reader, (ipfile,), [(self.queues["dedup"], 1)])),
+            threading.Thread(target = self._run, args = ("dedup", self._dedup, (), [(self.ordered, 1), (self.queues["geoip"], 1)])),
+            threading.Thread(target = self._run, args = ("geoip", self._geoip, (), [(self.queues["dnsbl"], self.workers)])),
+            threading.Thread(target = self._monitor),
+        ]
+        for i in xrange(self.workers):
+            threads.append(threading.Thread(target = self._run, args = ("dnsbl", self._dnsbl, (), [])))
+        for t in threads:
+            # a failed writer must not leave the process waiting on full queues
+            t.daemon = True
+            t.start()
+        try:
+            while True:
+                item = self.ordered.get()
+                if item == None:
+                    break
+                gistuff, bl = self._wait(item)
+                ip = "/".join(item.split("."))
+                robtex_url = "{0}/{1}".format(robtex, ip)
+                self.out.append([item, gistuff["country_code"], gistuff["country_name"], bl[0], bl[1], bl[2], bl[3], robtex_url])
+                if summary != None:
+                    summary.add(item, gistuff, bl[0])
+                self._count("writer")
+            if self.failed != None:
+                raise RuntimeError("{0} stage failed:\n{1}".format(*self.failed))
+        finally:
+            self.finished = True
+        return summary
+
+    def stats(self):
+        lines = ["{0:8} {1:>10} {2:>12} {3:>16}".format("stage", "items", "items/sec", "queue avg/max")]
+        for stage in self.stages:
+            start, end = self.times.get(stage, (0, 0))
+            rate = self.counts[stage] / (end - start) if end > start else 0
+            depth = ""
+            if stage in self.depths:
+                total, samples, peak = self.depths[stage]
+                depth = "{0:.0f}/{1}".format(total / float(samples) if samples else 0, peak)
+            lines.append("{0:8} {1:>10} {2:>12.0f} {3:>16}".format(stage, self.counts[stage], rate, depth))
+        return "\n".join(lines)
+
 def usage():
     print sys.argv[0], "\n"
     print " -f <IP file>"
     print " -e <excel output file (default csv to stdout)>"
     print " -g <GeoLiteCity.dat file>"
     print " -c [optional: this will add color to excel file]"
+    print " -a [optional: check blacklists for all IPs concurrently]"
+    print " -n <nameserver[:port] for -a (default from resolv.conf)>"
+    print " -q <maximum queries in flight for -a (default 200)>"
+    print " -r <maximum queries per second to each blacklist for -a (default 50)>"
+    print " -k <lookup cache file, reused across runs>"
+    print " -s <maximum number of entries in the lookup cache (default 1000000)>"
+    print " -m <GeoIP database access: standard (read from disk), mmap or memory (default standard)>"
+    print " -o [optional: look up unique addresses in address order]"
+    print " -b [optional: one GeoIP lookup per network block, stop blacklist lookups for an IP"
+    print "     once it is listed, and add a per block summary]"
+    print " -w <csv or parquet output file, picked by extension (.csv/.parquet)>"
+    print " -p <blacklist threads: stream the file through a lookup pipeline and report"
+    print "     per stage throughput and queue depth to stderr (-o is ignored)>"
 
 def main():
     ipfile = None
     excelfile = None
+    outfile = None
     GeoLite = None
-    wb = None
-    ws = None
     color = False
+    concurrent = False
+    nameserver = None
+    port = 53
+    inflight = 200
+    rate = 50
+    cachefile = None
+    cachesize = 1000000
+    geoipmode = "standard"
+    order = False
+    blocks = False
+    workers = 0
     header = ["IP Address", "Country Code", "Country Name", "Blacklisted", "Code", "Server", "Details", "Robtex Info"]
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hf:g:e:c", ["help", "file=", "geolitecity=", "excelfile=", "coloring"])
+        opts, args = getopt.getopt(sys.argv[1:], "hf:g:e:can:q:r:k:s:m:obw:p:", ["help", "file=", "geolitecity=", "excelfile=", "coloring", "async", "nameserver=", "inflight=", "rate=", "cache=", "cachesize=", "geoipmode=", "order", "blocks", "write=", "pipeline="])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
@@ -191,10 +1009,6 @@ def main():
                 print "You must install OpenPyxl 2.1.2+ for xlsx format:\n\thttps://pypi.python.org/pypi/openpyxl"
                 sys.exit(-1)
             excelfile = a
-            wb = Workbook(optimized_write = True)
-            ws = wb.create_sheet()
-            ws.title = "IP Address Info"
-            ws.append(header)
         elif o in ("-g", "--geolitecity"):
             GeoLite = a
         elif o in ("-f", "--file"):
@@ -206,6 +1020,43 @@ def main():
                 sys.exit(-1)
         elif o in ("-c", "--coloring"):
             color = True
+        elif o in ("-a", "--async"):
+            concurrent = True
+        elif o in ("-n", "--nameserver"):
+            if ":" in a:
+                nameserver, port = a.split(":")
+                port = int(port)
+            else:
+                nameserver = a
+        elif o in ("-q", "--inflight"):
+            inflight = int(a)
+        elif o in ("-r", "--rate"):
+            rate = float(a)
+            if rate <= 0:
+                print "the rate has to be more than 0 queries per second"
+                usage()
+                sys.exit(-1)
+        elif o in ("-k", "--cache"):
+            cachefile = a
+        elif o in ("-s", "--cachesize"):
+            cachesize = int(a)
+        elif o in ("-m", "--geoipmode"):
+            if a not in geoipmodes:
+                print a + " is not one of: " + ", ".join(sorted(geoipmodes.keys()))
+                usage()
+                sys.exit(-1)
+            geoipmode = a
+        elif o in ("-o", "--order"):
+            order = True
+        elif o in ("-b", "--blocks"):
+            blocks = True
+        elif o in ("-w", "--write"):
+            if a.lower().endswith(".parquet") and not has_pyarrow:
+                print "You must install pyarrow for parquet output:\n\thttps://pypi.python.org/pypi/pyarrow"
+                sys.exit(-1)
+            outfile = a
+        elif o in ("-p", "--pipeline"):
+            workers = int(a)
         else:
             assert False, "unhandled option\n\n"
             sys.exit(-2)
@@ -214,41 +1065,105 @@ def main():
         usage()
         sys.exit(2)
 
-    gi = GeoIP(GeoLite)
-    if excelfile == None:
-        print ",".join(x for x in header)
+    gi = GeoIP(GeoLite, geoipmodes[geoipmode])
+    if excelfile != None:
+        out = XlsxOutput(excelfile, header, color = color)
+    elif outfile != None and outfile.lower().endswith(".parquet"):
+        out = ParquetOutput(outfile, header)
+    elif outfile != None:
+        out = CSVOutput(outfile, header)
+    else:
+        out = TextOutput(header)
+
+    cache = None
+    geoversion = ""
+    if cachefile != None:
+        cache = LookupCache(cachefile, maxentries = cachesize)
+        geoversion = GeoIPVersion(GeoLite)
+
+    if workers > 0:
+        checker = None
+        if concurrent:
+            checker = DNSBLChecker(nameserver = nameserver, port = port, inflight = inflight, rate = rate)
+        pipeline = Pipeline(gi, out, cache = cache, geoversion = geoversion, blocks = blocks, checker = checker, workers = workers)
+        summary = pipeline.run(ipfile)
+        if summary != None:
+            out.summary(BlockSummary.header, summary.rows())
+        sys.stderr.write("Pipeline:\n" + pipeline.stats() + "\n")
+        if cache != None:
+            cache.close()
+            sys.stderr.write("Lookup cache:\n" + cache.stats() + "\n")
+        out.close()
+        return
+
+    lines = ipfile.readlines()
+    geo = {}
+    todo = []
+    for item in set(i.strip() for i in lines):
+        if cache != None:
+            geo[item] = cache.get(item, "geoip", geoversion)
+        # entries cached without -b don't know their network
+        if geo.get(item) == None or (blocks and "network" not in geo[item]):
+            todo.append(item)
+    if blocks:
+        found = GeoBlockLookup(gi, todo)
+    else:
+        found = GeoLookup(gi, todo, sort = order)
+    geo.update(found)
+    if cache != None:
+        for item, gistuff in found.items():
+            value = {"country_code": gistuff["country_code"], "country_name": gistuff["country_name"]}
+            if "network" in gistuff:
+                value["network"] = gistuff["network"]
+            cache.put(item, "geoip", value, version = geoversion)
 
-    total = 1
-    for i in ipfile.readlines():
+    blacklists = None
+    if concurrent:
+        blacklists = {}
+        todo = []
+        for item in set(i.strip() for i in lines):
+            if cache != None:
+                blacklists[item] = cache.get(item, "dnsbl")
+            if blacklists.get(item) == None:
+                todo.append(item)
+        checker = DNSBLChecker(nameserver = nameserver, port = port, inflight = inflight, rate = rate)
+        blacklists.update(checker.check(todo, shortcircuit = blocks))
+        if cache != None:
+            for item in todo:
+                cache.put(item, "dnsbl", blacklists[item], checker.ttls[item])
+    verdicts = {}
+    for i in lines:
         item =  i.strip()
         rev = '.'.join(item.split('.')[::-1])
-        gistuff = gi.record_by_addr(item)
+        gistuff = geo[item]
         ip = "/".join(item.split("."))
         robtex_url = "{0}/{1}".format(robtex, ip)
-        bl = checkbl(rev)
-        line = [item, gistuff["country_code"], gistuff["country_name"], bl[0], bl[1], bl[2], bl[3], robtex_url]
-        if excelfile == None:
-            print ",".join(x for x in line)
+        if blacklists != None:
+            bl = blacklists[item]
         else:
-            ws.append(line)
-            total += 1
+            bl = None
+            if cache != None:
+                bl = cache.get(item, "dnsbl")
+            if bl == None:
+                bl = checkbl(rev)
+                if cache != None:
+                    cache.put(item, "dnsbl", bl, DNSBL_TTL)
+        verdicts[item] = bl[0]
+        line = [item, gistuff["country_code"], gistuff["country_name"], bl[0], bl[1], bl[2], bl[3], robtex_url]
+        out.append(line)
 
-    if excelfile:
-        wb.save(filename = excelfile)
-        if not color:
-            return
-        wb = load_workbook(filename = excelfile)
-        ws = wb.get_sheet_by_name(name = "IP Address Info")
-        for col in xrange(1, len(header) + 1):
-            ws.cell("{0}{1}".format(get_column_letter(col), 1)).style = BoldStyle
+    if blocks:
+        summary = BlockSummary()
+        for i in lines:
+            item = i.strip()
+            summary.add(item, geo[item], verdicts[item])
+        out.summary(BlockSummary.header, summary.rows())
 
-        for row in xrange(2, total + 1):
-            for col in xrange(1, len(header) + 1):
-                if ws.cell("{0}{1}".format(get_column_letter(4), row)).value == "Yes":
-                    ws.cell("{0}{1}".format(get_column_letter(col), row)).style = RedStyle
-                else:
-                    ws.cell("{0}{1}".format(get_column_letter(col), row)).style = GreenStyle
-        wb.save(filename = excelfile)
+    if cache != None:
+        cache.close()
+        sys.stderr.write("Lookup cache:\n" + cache.stats() + "\n")
+
+    out.close()
 
 if __name__ == "__main__":
     main()
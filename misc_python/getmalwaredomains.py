@@ -15,9 +15,19 @@ import os, sys
 import getopt
 import httplib
 import sqlite3
+import socket
+import threading
+import Queue
+import random
+import time
+import struct
+import re
+import bisect
+from array import array
 
 DBNAME  = "malwaredomains.db"
 MAXWAIT = (60*10) # ten minutes 
+HOST    = "www.malwaredomainlist.com"
 
 def usage():
     print 'getmalwaredomains.py:'
@@ -26,14 +36,38 @@ def usage():
     print '\t-d, --database : sqlite3 db to store domain info (default malwaredomains.db)'
     print '\t-b, --bulk     : bulk upload up to given number of pages'
     print '\t-u, --update   : process entries from update link'
-    print '\t-a, --add      : add a particular domain\n'
+    print '\t-a, --add      : add a particular domain'
+    print '\t-w, --workers  : connections used to fetch pages for bulk (default 4)'
+    print '\t-s, --server   : host[:port] to fetch from instead of ' + HOST + '\n'
+    print 'getmalwaredomains.py query:'
+    print '  - searches the database'
+    print '\t-d, --database : sqlite3 db to search (default malwaredomains.db)'
+    print '\t-m, --match    : text anywhere in the domain or reverse lookup'
+    print '\t-x, --suffix   : domain or any subdomain of it (example.com matches www.example.com)'
+    print '\t-i, --ip       : IP address or CIDR block (10.1.0.0/16)'
+    print '\t-f, --from     : first date, YYYY/MM/DD[ HH:MM]'
+    print '\t-t, --to       : last date, YYYY/MM/DD[ HH:MM]'
+    print '\t-l, --limit    : maximum number of rows, newest first (default all)\n'
+    print 'getmalwaredomains.py match [options] logfile ...:'
+    print '  - finds domains (and their subdomains) and IPs from the database in log files'
+    print '\t-d, --database : sqlite3 db to load (default malwaredomains.db)'
+    print '\t-o, --output   : file for the hits (default stdout), one per line:'
+    print '\t                 file:line, domain or ip, database entry, what matched in the log'
+    print '\t logfile - reads stdin\n'
 
 class malwaredomains:
+    def __init__(self, host = HOST, port = 80):
+        self.host = host
+        self.port = port
+
+    def pagepath(self, page):
+        return '/mdl.php?inactive=&sort=Date&search=&colsearch=All&ascordesc=DESC&quantity=100&page=' + page
+
     def adddomain(self, d):
         domain = d
         url = 'http://www.malwaredomainlist.com/mdl.php?search=' + domain + '&colsearch=All&quantity=50'
         try:
-            conn = httplib.HTTPConnection('www.malwaredomainlist.com')
+            conn = httplib.HTTPConnection(self.host, self.port)
             conn.request('GET', '/mdl.php?search=' + domain + '&colsearch=All&quantity=50')
             response = conn.getresponse().read()
             if response.find('Date (UTC)') != -1: 
@@ -50,7 +84,7 @@ class malwaredomains:
     def getupdates(self):
         url = 'http://www.malwaredomainlist.com/update.php'
         try:
-            conn = httplib.HTTPConnection('www.malwaredomainlist.com')
+            conn = httplib.HTTPConnection(self.host, self.port)
             conn.request('GET', '/update.php')
             response = conn.getresponse().read()
             if response.find('Date (UTC)') != -1: 
@@ -69,8 +103,8 @@ class malwaredomains:
         url = 'http://www.malwaredomainlist.com/mdl.php'
         page = page
         try:
-            conn = httplib.HTTPConnection('www.malwaredomainlist.com')
-            conn.request('GET', '/mdl.php?inactive=&sort=Date&search=&colsearch=All&ascordesc=DESC&quantity=100&page=' + page) 
+            conn = httplib.HTTPConnection(self.host, self.port)
+            conn.request('GET', self.pagepath(page))
             response = conn.getresponse().read()
             if response.find('Date (UTC)') != -1:
                 print "Page exists: %s" % url
@@ -83,36 +117,126 @@ class malwaredomains:
 
         return None
 
+class PageFetcher:
+    '''
+    Fetches a list of pages with a fixed number of worker threads, each
+    keeping one keep-alive HTTPConnection open for all of its requests.
+    Failed requests (connection errors, 429 and 5xx) are retried with
+    exponential backoff.  validators maps path -> (etag, last modified)
+    from an earlier run; those pages are asked for with If-None-Match /
+    If-Modified-Since and come back as 304 if unchanged
+    '''
+    def __init__(self, host, port = 80, workers = 4, retries = 3, backoff = 1.0, timeout = 30, validators = None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.validators = validators or {}
+        self.results = {}
+        self.done = threading.Condition()
+        self.stopped = False
+        self.connections = 0
+        self.requests = 0
+
+    def fetch(self, paths):
+        '''
+        Yields (path, status, data, validator) in the order of paths as the
+        pages come in.  status is the HTTP status, or None if the page could
+        not be fetched, in which case data is the error
+        '''
+        todo = Queue.Queue()
+        for index, path in enumerate(paths):
+            todo.put((index, path))
+        threads = []
+        for i in xrange(min(self.workers, len(paths))):
+            t = threading.Thread(target = self._worker, args = (todo,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            for index in xrange(len(paths)):
+                with self.done:
+                    while index not in self.results:
+                        if not any(t.is_alive() for t in threads):
+                            # the workers are gone without fetching it
+                            self.results[index] = (None, "no worker left to fetch the page", None)
+                            break
+                        self.done.wait(0.5)
+                    result = self.results.pop(index)
+                yield (paths[index],) + result
+        finally:
+            # the caller may stop early, don't fetch the rest
+            self.stopped = True
+            for t in threads:
+                t.join()
+
+    def _worker(self, todo):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+        with self.done:
+            self.connections += 1
+        try:
+            while not self.stopped:
+                try:
+                    index, path = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    result = self._get(conn, path)
+                except Exception, e:
+                    # anything else still has to be posted, fetch() waits for every page
+                    conn.close()
+                    result = (None, e, None)
+                with self.done:
+                    self.results[index] = result
+                    self.done.notify_all()
+        finally:
+            conn.close()
+
+    def _get(self, conn, path):
+        headers = {}
+        etag, modified = self.validators.get(path, (None, None))
+        if etag != None:
+            headers['If-None-Match'] = etag
+        if modified != None:
+            headers['If-Modified-Since'] = modified
+        error = None
+        for attempt in xrange(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            with self.done:
+                self.requests += 1
+            try:
+                conn.request('GET', path, headers = headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                # the server may have closed the keep-alive connection, the next request reconnects
+                conn.close()
+                error = e
+                continue
+            if response.status == 304:
+                return (304, None, (etag, modified))
+            if response.status == 429 or response.status >= 500:
+                error = "HTTP %d" % response.status
+                continue
+            return (response.status, data, (response.getheader('etag'), response.getheader('last-modified')))
+        return (None, error, None)
+
 class Domains:
     def __init__(self, data):
         self.data = data
         self.column_names = {0 : 'Date', 1 : 'Domain', 2 : 'IP',  3 : 'Rlookup', 4 : 'Description', 5 : 'Registrant', 6 : 'ASN', 7 : 'COUNTRY'}
 
     def process_entries(self, str):
-        items = []
         line = str
-        line.rstrip()
-        line.lstrip()    
-        line.strip()
-        line = line.replace('<nobr>', '')
-        line = line.replace('</nobr>', '')
-        line = line.replace('<wbr>', '')
+        if line.find('<') != -1:
+            line = line.replace('<nobr>', '').replace('</nobr>', '').replace('<wbr>', '')
         line = line.strip("<wbr>")
         return line
 
-
-    def process_column(self, column, ncol):
-        start_value = column.find('>')
-        if start_value == -1:
-            return
-
-        column = column[start_value+1:]
-
-        end_column = column.find('</td>')
-        if end_column == -1:
-            return
-
-        str = column[0:end_column]
+    def process_value(self, str, ncol):
         if str.find('img src') != -1:
             return None
         if self.column_names[ncol] == 'Date':
@@ -136,65 +260,77 @@ class Domains:
 
         return None
 
-    def process_row(self, row):
-        end_row = row.find('</tr>')
+    # the parsers below never copy the rest of the page, every find is
+    # given the offsets of the table, row or column it is looking in
+
+    def parse_column(self, data, start, end, ncol):
+        start_value = data.find('>', start, end)
+        if start_value == -1:
+            return
+
+        end_column = data.find('</td>', start_value + 1, end)
+        if end_column == -1:
+            return
+
+        return self.process_value(data[start_value+1:end_column], ncol)
+
+    def parse_row(self, data, start, end):
+        end_row = data.find('</tr>', start, end)
         if end_row == -1:
             return
 
-        row = row[0:end_row]
-        offset = 0
         ncol = 0
-
         row_info = {}
 
-        while row[offset:].find('<td') != -1:
-            ofs = row[offset:].find('<td') + 3
-            column = row[offset+ofs:]
-            info = self.process_column(column, ncol)
+        offset = data.find('<td', start, end_row)
+        while offset != -1:
+            info = self.parse_column(data, offset + 3, end_row, ncol)
             if info != None:
                 row_info.update(info)
-            offset += ofs
             ncol += 1
             ncol = ncol % 8
+            offset = data.find('<td', offset + 3, end_row)
 
         return row_info
 
+    def process_column(self, column, ncol):
+        return self.parse_column(column, 0, len(column), ncol)
 
-    def extract(self):
+    def process_row(self, row):
+        return self.parse_row(row, 0, len(row))
+
+    def rows(self):
+        '''
+        Yields the row dicts of the table in one pass over the page
+        '''
         data = self.data
-        table_data = ''
         start_table = data.find('Date (UTC)')
-        if start_table != -1:
-            end_table = data[start_table:].find('</table>')
-            if end_table != -1:
-                table_data = data[start_table:start_table+end_table]
+        if start_table == -1:
+            return
+        end_table = data.find('</table>', start_table)
+        if end_table == -1:
+            return
 
-        offset = 0
         nrow = 0
-        domain_info = []
-
-        while table_data[offset:].find('<tr') != -1:
-
-            ofs = table_data[offset:].find('<tr') + 4
-            row = table_data[offset+ofs:]
+        offset = data.find('<tr', start_table, end_table)
+        while offset != -1:
             if nrow > 0:
-                row_info = self.process_row(row)
-                domain_info.append(row_info)
-            offset += ofs
+                yield self.parse_row(data, offset + 4, end_table)
             nrow += 1
+            offset = data.find('<tr', offset + 4, end_table)
 
-        return domain_info
+    def extract(self):
+        return list(self.rows())
 
 def init():
     global DBNAME
-    if os.path.isfile(DBNAME):
-        return
+    new = not os.path.isfile(DBNAME)
 
     conn = sqlite3.connect(DBNAME)
     curs = conn.cursor()
     
     curs.executescript('''
-    CREATE TABLE domains (
+    CREATE TABLE IF NOT EXISTS domains (
             id          INTEGER PRIMARY KEY,
             domain      TEXT,
             ip          TEXT,
@@ -202,38 +338,360 @@ def init():
             date        TEXT
         );
     ''')
+    # WAL is kept in the database file, readers don't block the bulk inserts
+    curs.execute("PRAGMA journal_mode=WAL")
+
+    # schema migrations, PRAGMA user_version is the last one applied
+    version = curs.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # one row per domain/ip/rlookup/date, older databases can have duplicates
+        curs.executescript('''
+        DELETE FROM domains WHERE id NOT IN
+            (SELECT MIN(id) FROM domains GROUP BY domain, ip, rlookup, date);
+        CREATE UNIQUE INDEX IF NOT EXISTS domains_unique ON domains(domain, ip, rlookup, date);
+        PRAGMA user_version = 1;
+        ''')
+    if version < 2:
+        # numeric copy of ip for CIDR lookups, indexes for the query subcommand
+        conn.create_function("ip2long", 1, ip2long)
+        curs.execute("ALTER TABLE domains ADD COLUMN ipnum INTEGER")
+        curs.execute("UPDATE domains SET ipnum = ip2long(ip)")
+        curs.executescript('''
+        CREATE INDEX IF NOT EXISTS domains_ip ON domains(ip);
+        CREATE INDEX IF NOT EXISTS domains_ipnum ON domains(ipnum);
+        CREATE INDEX IF NOT EXISTS domains_date ON domains(date);
+        ''')
+        # trigram tokens let MATCH find any substring of 3 or more characters
+        try:
+            curs.executescript('''
+            CREATE VIRTUAL TABLE domains_fts USING fts5(domain, rlookup, content='domains', content_rowid='id', tokenize='trigram');
+            CREATE TRIGGER domains_fts_insert AFTER INSERT ON domains BEGIN
+                INSERT INTO domains_fts(rowid, domain, rlookup) VALUES (new.id, new.domain, new.rlookup);
+            END;
+            CREATE TRIGGER domains_fts_delete AFTER DELETE ON domains BEGIN
+                INSERT INTO domains_fts(domains_fts, rowid, domain, rlookup) VALUES ('delete', old.id, old.domain, old.rlookup);
+            END;
+            INSERT INTO domains_fts(domains_fts) VALUES ('rebuild');
+            ''')
+        except sqlite3.OperationalError, e:
+            print "No full text index (%s), text searches will scan the table" % e
+        curs.execute("PRAGMA user_version = 2")
+    conn.commit()
     curs.close()
+    conn.close()
 
+    if not new:
+        return
     if os.path.isfile(DBNAME):
         print "Success."
     else:
         print "Failed."
 
+def ip2long(ip):
+    if ip == None or ip.count('.') != 3:
+        return None
+    try:
+        return struct.unpack("!L", socket.inet_aton(ip))[0]
+    except socket.error:
+        return None
+
+def hostsuffix(domain, suffix):
+    host = domain.split('/')[0].lower()
+    return host == suffix or host.endswith('.' + suffix)
+
+def ftsphrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def search(conn, match = None, suffix = None, ip = None, since = None, until = None, limit = None):
+    '''
+    Returns (domain, ip, rlookup, date) rows, newest first.  Text searches
+    go through the domains_fts trigram index when there is one and the
+    text is at least 3 characters, otherwise they fall back to LIKE
+    '''
+    fts = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'domains_fts'").fetchone()[0] > 0
+    conn.create_function("hostsuffix", 2, hostsuffix)
+    sql = "SELECT domain, ip, rlookup, date FROM domains"
+    where = []
+    params = []
+    for column, text in ((None, match), ('domain', suffix)):
+        if text == None:
+            continue
+        if fts and len(text) >= 3:
+            query = ftsphrase(text)
+            if column != None:
+                query = column + ' : ' + query
+            where.append("id IN (SELECT rowid FROM domains_fts WHERE domains_fts MATCH ?)")
+            params.append(query)
+        elif column != None:
+            where.append("domain LIKE ?")
+            params.append('%' + text + '%')
+        else:
+            where.append("(domain LIKE ? OR rlookup LIKE ?)")
+            params += ['%' + text + '%'] * 2
+    if suffix != None:
+        # MATCH only narrows it down to domains containing the text
+        where.append("hostsuffix(domain, ?)")
+        params.append(suffix.lower().lstrip('.'))
+    if ip != None:
+        if ip.find('/') != -1:
+            address, bits = ip.split('/')
+            bits = int(bits)
+            start = ip2long(address)
+            if start == None or bits < 0 or bits > 32:
+                raise ValueError("bad CIDR block: " + ip)
+            start &= (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+            where.append("ipnum BETWEEN ? AND ?")
+            params += [start, start + (1 << (32 - bits)) - 1]
+        else:
+            where.append("ip = ?")
+            params.append(ip)
+    # dates are stored as YYYY/MM/DD HH:MM so they sort as text
+    if since != None:
+        where.append("date >= ?")
+        params.append(since.replace('-', '/'))
+    if until != None:
+        where.append("date < ?")
+        params.append(until.replace('-', '/') + '~')
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY date DESC"
+    if limit != None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+def query(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hd:m:x:i:f:t:l:", ["help", "database=", "match=", "suffix=", "ip=", "from=", "to=", "limit="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    global DBNAME
+    filters = {}
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-d", "--database"):
+            DBNAME = a
+        elif o in ("-m", "--match"):
+            filters['match'] = a
+        elif o in ("-x", "--suffix"):
+            filters['suffix'] = a
+        elif o in ("-i", "--ip"):
+            filters['ip'] = a
+        elif o in ("-f", "--from"):
+            filters['since'] = a
+        elif o in ("-t", "--to"):
+            filters['until'] = a
+        elif o in ("-l", "--limit"):
+            filters['limit'] = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    if not os.path.isfile(DBNAME):
+        print DBNAME + " does not exist"
+        sys.exit(-1)
+    # brings older databases up to date
+    init()
+
+    conn = sqlite3.connect(DBNAME)
+    conn.text_factory = str
+    start = time.time()
+    try:
+        rows = search(conn, **filters)
+    except ValueError, e:
+        print e
+        sys.exit(-1)
+    for domain, ip, rlookup, date in rows:
+        print "%s\t%s\t%s\t%s" % (date, domain, ip, rlookup)
+    sys.stderr.write("%d rows in %.3fs\n" % (len(rows), time.time() - start))
+    conn.close()
+
+# anything that looks like a host name or dotted quad
+HOSTRE = re.compile(r'[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)+')
+
+class IOCMatcher:
+    '''
+    The domains table in memory for matching logs without a query per line.
+    Hosts go in a trie of nested dicts keyed by label from the TLD down, so
+    a log host matches when it or any parent domain is in the table.  IPs
+    (the ip column and hosts that are addresses) are a sorted array of
+    32 bit integers searched with bisect
+    '''
+    def __init__(self):
+        self.trie = {}
+        self.ips = array('I')
+        self.domains = 0
+
+    def add_domain(self, host):
+        node = self.trie
+        for label in reversed(host.split('.')):
+            node = node.setdefault(intern(label), {})
+        if '' not in node:
+            # labels are never empty, so '' marks the end of a domain
+            node[''] = True
+            self.domains += 1
+
+    def load(self, conn):
+        ips = set()
+        for domain, ip in conn.execute("SELECT domain, ip FROM domains"):
+            n = ip2long(ip)
+            if n != None:
+                ips.add(n)
+            if domain == None:
+                continue
+            host = domain.split('/')[0].split(':')[0].strip('.').lower()
+            n = ip2long(host)
+            if n != None:
+                ips.add(n)
+            elif host.find('.') != -1:
+                self.add_domain(host)
+        self.ips = array('I', sorted(ips))
+
+    def match_host(self, host):
+        # returns the database domain host falls under, or None
+        node = self.trie
+        labels = host.split('.')
+        for i in xrange(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node == None:
+                return None
+            if '' in node:
+                return '.'.join(labels[i:])
+        return None
+
+    def match_ip(self, n):
+        i = bisect.bisect_left(self.ips, n)
+        return i < len(self.ips) and self.ips[i] == n
+
+    def scan(self, line):
+        '''
+        Returns (kind, database entry, log token) for each match in line
+        '''
+        hits = []
+        for token in set(HOSTRE.findall(line)):
+            n = ip2long(token) if token[-1].isdigit() else None
+            if n != None:
+                if self.match_ip(n):
+                    hits.append(('ip', token, token))
+                continue
+            found = self.match_host(token.lower())
+            if found != None:
+                hits.append(('domain', found, token))
+        return hits
+
+def match(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hd:o:", ["help", "database=", "output="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    global DBNAME
+    output = sys.stdout
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-d", "--database"):
+            DBNAME = a
+        elif o in ("-o", "--output"):
+            output = open(a, "w")
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    if not args:
+        usage()
+        sys.exit(-1)
+    if not os.path.isfile(DBNAME):
+        print DBNAME + " does not exist"
+        sys.exit(-1)
+    init()
+
+    start = time.time()
+    conn = sqlite3.connect(DBNAME)
+    conn.text_factory = str
+    matcher = IOCMatcher()
+    matcher.load(conn)
+    conn.close()
+    sys.stderr.write("loaded %d domains and %d IPs in %.1fs\n" % (matcher.domains, len(matcher.ips), time.time() - start))
+
+    start = time.time()
+    lines = 0
+    hits = 0
+    for name in args:
+        if name == '-':
+            f = sys.stdin
+        else:
+            f = open(name, "r")
+        lineno = 0
+        for line in f:
+            lineno += 1
+            for kind, entry, token in matcher.scan(line):
+                output.write("%s:%d\t%s\t%s\t%s\n" % (name, lineno, kind, entry, token))
+                hits += 1
+        lines += lineno
+        if f != sys.stdin:
+            f.close()
+    elapsed = time.time() - start
+    sys.stderr.write("%d lines, %d hits in %.1fs (%.0f lines/sec)\n" % (lines, hits, elapsed, lines / max(elapsed, 1e-6)))
+    if output != sys.stdout:
+        output.close()
+
+def load_validators():
+    conn = sqlite3.connect(DBNAME)
+    conn.execute("CREATE TABLE IF NOT EXISTS pages (path TEXT PRIMARY KEY, etag TEXT, modified TEXT)")
+    validators = {}
+    for path, etag, modified in conn.execute("SELECT path, etag, modified FROM pages"):
+        validators[path] = (etag, modified)
+    conn.close()
+    return validators
+
+def save_validator(path, validator):
+    # only once the page is in the database, so a failed run fetches it again
+    conn = sqlite3.connect(DBNAME)
+    conn.execute("INSERT OR REPLACE INTO pages VALUES(?, ?, ?)", (path, validator[0], validator[1]))
+    conn.commit()
+    conn.close()
+
 def process_domains(domain_info):
     conn = sqlite3.connect(DBNAME)
     conn.text_factory = str
     cur = conn.cursor()
 
-    for info in domain_info:
-        cur.execute("SELECT COUNT(*) FROM domains where domain=? AND ip=? AND rlookup=? AND date=?", 
-                    (info['domains'],
-                    info['ips'], 
-                    info['rlookups'],
-                    info['dates']))
-        count = cur.fetchone()[0]
-        if count < 1:
-            cur.execute("INSERT INTO domains VALUES(null, ?, ?, ?, ?)", (info['domains'], info['ips'], info['rlookups'], info['dates']))
-            print '[domain]', info['domains'], '\n\t[IP] ', info['ips']
-        else:
-            print "NOT ADDED " +info['domains'] + '\n\twith IP: ' + info['ips'] + ' already in database, not added'
-        
+    rows = [0]
+    def values():
+        for info in domain_info:
+            rows[0] += 1
+            yield (info['domains'], info['ips'], info['rlookups'], info['dates'], ip2long(info['ips']))
+
+    # the unique index does the duplicate check, one transaction for the whole batch.
+    # new rows get ids after the current largest (total_changes would count the
+    # full text index trigger too)
+    before = cur.execute("SELECT IFNULL(MAX(id), 0) FROM domains").fetchone()[0]
+    cur.executemany("INSERT OR IGNORE INTO domains (domain, ip, rlookup, date, ipnum) VALUES(?, ?, ?, ?, ?)", values())
+    inserted = cur.execute("SELECT IFNULL(MAX(id), 0) FROM domains").fetchone()[0] - before
     conn.commit()
     conn.close()
 
+    print "%d domains added, %d already in database" % (inserted, rows[0] - inserted)
+    return inserted, rows[0] - inserted
+
 
 def main():          
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "match":
+        match(sys.argv[2:])
+        return
+
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hb:a:d:u", ["help", "bulk=", "add=", "database="])
+        opts, args = getopt.getopt(sys.argv[1:], "hb:a:d:uw:s:", ["help", "bulk=", "add=", "database=", "update", "workers=", "server="])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
@@ -241,6 +699,9 @@ def main():
     bulk = False
     update = False
     domain = None
+    workers = 4
+    host = HOST
+    port = 80
     global DBNAME
 
     for o, a in opts:
@@ -256,6 +717,14 @@ def main():
             DBNAME = a
         elif o in ("-u", "--update"):
             update = True
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-s", "--server"):
+            if ":" in a:
+                host, port = a.split(":")
+                port = int(port)
+            else:
+                host = a
         else:
             assert False, "unhandled option\n\n"
             sys.exit(2)
@@ -267,7 +736,7 @@ def main():
 
     init()
 
-    md = malwaredomains()
+    md = malwaredomains(host, port)
     data = None
 
     if domain != None:
@@ -276,31 +745,47 @@ def main():
             print "Cannot find url!"
         else: 
             fs = Domains(data) 
-            domain_info = fs.extract()
-            process_domains(domain_info)
+            process_domains(fs.rows())
     if update:
         data = md.getupdates()
         if data == None:
             print "Cannot find url!"
         else: 
             fs = Domains(data) 
-            domain_info = fs.extract()
-            process_domains(domain_info)
+            process_domains(fs.rows())
     if bulk:
         if int(pages) >= 0:
-            i = 0
-            while i <= int(pages):
-                data = md.getdomains(str(i))
-
-                if data == None:
+            start = time.time()
+            fetcher = PageFetcher(host, port, workers = workers, validators = load_validators())
+            paths = [md.pagepath(str(i)) for i in xrange(int(pages) + 1)]
+            fetched = 0
+            unchanged = 0
+            inserted = 0
+            skipped = 0
+            for path, status, data, validator in fetcher.fetch(paths):
+                url = 'http://' + host + (':%d' % port if port != 80 else '') + path
+                if status == 304:
+                    print "Not modified: %s" % url
+                    unchanged += 1
+                    continue
+                if status == None:
+                    print "Error connecting:", data
+                    print "Cannot find url!"
+                    break
+                if data == None or data.find('Date (UTC)') == -1:
                     print "Cannot find url!"
-                    return
-                else: 
-                    fs = Domains(data) 
-                    domain_info = fs.extract()
-   
-                    process_domains(domain_info)
-                i = i+1
+                    break
+                print "Page exists: %s" % url
+                fs = Domains(data)
+                added, existing = process_domains(fs.rows())
+                inserted += added
+                skipped += existing
+                if validator[0] != None or validator[1] != None:
+                    save_validator(path, validator)
+                fetched += 1
+            print "%d pages fetched, %d not modified, %d requests over %d connections in %.1fs" % (fetched, unchanged,
+                    fetcher.requests, fetcher.connections, time.time() - start)
+            print "%d domains added, %d already in database" % (inserted, skipped)
 
 if __name__ == "__main__":
     main()
@@ -3,6 +3,15 @@ import sys
 import os
 import getopt
 import struct
+import time
+import csv
+import multiprocessing
+import re
+import json
+import binascii
+import collections
+import codecs
+from operator import attrgetter
 
 """
 Author: Gleeda <jamie.levy@gmail.com>
@@ -17,8 +26,18 @@ jobparser.py
 
      -f <job>
      -d <directory of job files>
+     -r [optional: also look for job files in subdirectories of -d (one per host)]
+     -w <number of worker processes for -d (default number of CPUs)>
+     -e <csv report of the files that could not be parsed>
+     -j [optional: one JSON object per job instead of text]
+     -m <Field=regex: only show jobs whose field matches, e.g. Application=evil\.exe
+         (case insensitive, can be given more than once, all have to match)>
 """
 
+# I'm not sure what's the largest a job file can be, but I'm setting a limit 
+# just to avoid accidental imports of large files
+MAXJOBSIZE = 0x2000
+
 
 # http://msdn.microsoft.com/en-us/library/2d1fbbab-fe6c-4ae5-bdf5-41dc526b2439%28v=prot.13%29#id11
 products = {
@@ -166,28 +185,44 @@ exitcode = {
     0x80041328: "SCHED_E_START_ON_DEMAND",
 }
 
-class JobDate:
-    def __init__(self, data, scheduled = False):
-        # scheduled is the time the job was scheduled to run
+# Precompiled layouts, unpacked in place from a memoryview over the job data.
+# Priority and Flags are big endian, they are read little endian with the
+# rest of the fixed section and swapped
+# http://msdn.microsoft.com/en-us/library/cc248286%28v=prot.13%29.aspx
+FIXED = struct.Struct("<HH" + "IHH8B" + "6H" + "IiIiI" + "8H" + "HH")
+# everything between the user data and the trigger specific fields
+TRIGGER = struct.Struct("<HiiHHH3H3HHHiiii")
+# the trigger specific fields, padding and reserved fields after them
+TRIGGERTAIL = struct.Struct("<6xHHH")
+SIGNATURE = struct.Struct("<HH")
+USHORT = struct.Struct("<H")
+TRIGGERSPECIFIC = {
+    1: struct.Struct("<H"),
+    2: struct.Struct("<HH"),
+    3: struct.Struct("<IH"),
+    4: struct.Struct("<HHH"),
+}
+
+def swap32(n):
+    return ((n & 0xFF) << 24) | ((n & 0xFF00) << 8) | ((n >> 8) & 0xFF00) | (n >> 24)
+
+class JobDate(object):
+    __slots__ = ("scheduled", "Year", "Month", "Weekday", "Day", "Hour", "Minute", "Second", "Milliseconds")
+
+    def __init__(self, fields, scheduled = False):
+        # fields are the unpacked SYSTEMTIME (8 shorts), or year, month, day when
+        # scheduled is set (the time the job was scheduled to run)
         self.scheduled = scheduled
-        self.Year = struct.unpack("<H", data[:2])[0]
-        self.Month = struct.unpack("<H", data[2:4])[0]
         if not self.scheduled:
-            self.Weekday = struct.unpack("<H", data[4:6])[0]
-            self.Day = struct.unpack("<H", data[6:8])[0]
-            self.Hour = struct.unpack("<H", data[8:10])[0]
-            self.Minute = struct.unpack("<H", data[10:12])[0]
-            self.Second = struct.unpack("<H", data[12:14])[0]
-            self.Milliseconds = struct.unpack("<H", data[14:16])[0]
+            self.Year, self.Month, self.Weekday, self.Day, self.Hour, self.Minute, self.Second, self.Milliseconds = fields
         else:
+            self.Year, self.Month, self.Day = fields
             self.Weekday = None
-            self.Day = struct.unpack("<H", data[4:6])[0]
             self.Hour = 00
             self.Minute = 00
             self.Second = 00
             self.Milliseconds = 00
 
-
     def __repr__(self):
         day = weekdays.get(self.Weekday, None)
         mon = months.get(self.Month, None)
@@ -201,297 +236,437 @@ class JobDate:
 
 # http://msdn.microsoft.com/en-us/library/aa379358%28v=vs.85%29.aspx
 # http://msdn.microsoft.com/en-us/library/cc248286%28v=prot.10%29.aspx
-class UUID:
-    def __init__(self, data):
-        self.UUID0 = struct.unpack("<I", data[:4])[0]
-        self.UUID1 = struct.unpack("<H", data[4:6])[0]
-        self.UUID2 = struct.unpack("<H", data[6:8])[0]
-        self.UUID3 = struct.unpack(">H", data[8:10])[0]
-        self.UUID4 = struct.unpack(">H", data[10:12])[0]
-        self.UUID5 = struct.unpack(">H", data[12:14])[0]
-        self.UUID6 = struct.unpack(">H", data[14:16])[0]
+class UUID(object):
+    __slots__ = ("UUID0", "UUID1", "UUID2", "UUID3", "UUID4", "UUID5", "UUID6")
+
+    def __init__(self, fields):
+        # a little endian int and two shorts, then 8 bytes read as big endian shorts
+        self.UUID0, self.UUID1, self.UUID2 = fields[:3]
+        self.UUID3 = (fields[3] << 8) | fields[4]
+        self.UUID4 = (fields[5] << 8) | fields[6]
+        self.UUID5 = (fields[7] << 8) | fields[8]
+        self.UUID6 = (fields[9] << 8) | fields[10]
 
     def __repr__(self):
         return "{" + "{0:08X}-{1:04X}-{2:04X}-{3:04X}-{4:02X}{5:02X}{6:02X}".format(self.UUID0, self.UUID1, self.UUID2, 
                 self.UUID3, self.UUID4, self.UUID5, self.UUID6) + "}"
 
-class TriggerFields:
-    def __init__(self, data, ttype):
+class TriggerFields(object):
+    __slots__ = ("ttype", "DaysInterval", "WeeksInterval", "DaysOfTheWeek", "Days", "Months", "WhichWeek")
+
+    def __init__(self, buf, offset, ttype):
         self.ttype = ttype
+        if self.ttype not in TRIGGERSPECIFIC:
+            return
+        fields = TRIGGERSPECIFIC[self.ttype].unpack_from(buf, offset)
         if self.ttype == 1:
-            self.DaysInterval = struct.unpack("<H", data[:2])[0]
+            self.DaysInterval, = fields
         elif self.ttype == 2:
-            self.WeeksInterval = struct.unpack("<H", data[:2])[0]
-            self.DaysOfTheWeek = struct.unpack("<H", data[2:4])[0]
+            self.WeeksInterval, self.DaysOfTheWeek = fields
         elif self.ttype == 3:
-            self.Days = struct.unpack("<I", data[:4])[0]
-            self.Months = struct.unpack("<H", data[4:6])[0]
+            self.Days, self.Months = fields
         elif self.ttype == 4:
-            self.WhichWeek = struct.unpack("<H", data[:2])[0]
-            self.DaysOfTheWeek = struct.unpack("<H", data[2:4])[0]
-            self.Months = struct.unpack("<H", data[4:6])[0]
+            self.WhichWeek, self.DaysOfTheWeek, self.Months = fields
 
-    def __repr__(self):
+    def items(self):
         if self.ttype == 1:
-            return "Days Interval: {0}\n".format(self.DaysInterval)
+            return [("Days Interval", self.DaysInterval)]
         elif self.ttype == 2:
-            return "Weeks Interval: {0}\nDays Of The Week: {1}\n".format(self.DaysInterval, self.DaysOfTheWeek)
+            return [("Weeks Interval", self.WeeksInterval), ("Days Of The Week", self.DaysOfTheWeek)]
         elif self.ttype == 3:
-            return "Days: {0}\nMonths: {1}\n".format(self.Days, self.Months)
+            return [("Days", self.Days), ("Months", self.Months)]
         elif self.ttype == 4:
-            return "Which Week: {0}\nDays Of The Week: {1}\nMonths: {2}\n".format(self.WhichWeek, self.DaysOfTheWeek, self.Months)
-        return ""
+            return [("Which Week", self.WhichWeek), ("Days Of The Week", self.DaysOfTheWeek), ("Months", self.Months)]
+        return []
+
+    def __repr__(self):
+        return "".join("{0}: {1}\n".format(name, value) for name, value in self.items())
                 
-# http://msdn.microsoft.com/en-us/library/cc248285%28PROT.10%29.aspx
-class Job:
-    def __init__(self, data):
+utf16le = codecs.utf_16_le_decode
+
+def utf16(buf, start, size):
+    # size is in characters and counts the terminating NUL, the codec
+    # takes the memoryview slice without a tobytes() copy
+    return utf16le(buf[start:start + size * 2], "replace")[0].rstrip(u"\x00")
+
+JOBFIELDS = ("ProductInfo", "FileVersion", "UUID", "AppNameLenOffset", "TriggerOffset", "ErrorRetryCount",
+        "ErrorRetryInterval", "IdleDeadline", "IdleWait", "Priority", "MaxRunTime", "ExitCode", "Status", "Flags",
+        "RunDate", "RunningInstanceCount", "NameLength", "cursor", "Name", "ParameterSize", "Parameter",
+        "WorkingDirectorySize", "WorkingDirectory", "UserSize", "User", "CommentSize", "Comment", "UserDataSize",
+        "UserData", "ReservedDataSize", "StartError", "TaskFlags", "TriggerCount", "TriggerSize", "Reserved1",
+        "ScheduledStart", "ScheduledEnd", "StartHour", "StartMinute", "MinutesDuration", "MinutesInterval",
+        "TriggerFlag", "TriggerType", "TriggerSpecific", "Padding", "Reserved2", "Reserved3", "Test",
+        "SignatureVersion", "MinClientVersion", "JobSignature")
+
+# the strings of the variable length section in file order: field, size field, value if empty
+STRINGS = [
+    ("Name", "NameLength", None),
+    ("Parameter", "ParameterSize", ""),
+    ("WorkingDirectory", "WorkingDirectorySize", "Working Directory not set"),
+    ("User", "UserSize", "User not set"),
+    ("Comment", "CommentSize", "Comment not set"),
+    ("UserData", "UserDataSize", None),
+]
+
+class JobBase(object):
+    '''
+    Decodes the parts of a job file into attributes, Job runs all of it
+    up front and JobView only what gets asked for
+    '''
+    __slots__ = JOBFIELDS + ("buf", "offsets", "start", "loaded")
+
+    def _fixed(self):
         '''
         Fixed length section
         http://msdn.microsoft.com/en-us/library/cc248286%28v=prot.13%29.aspx
+        (and the first two fields of the variable length section)
         '''
-        self.ProductInfo = struct.unpack("<H", data[:2])[0]
-        self.FileVersion = struct.unpack("<H", data[2:4])[0]
-        self.UUID = UUID(data[4:20])
-        self.AppNameLenOffset = struct.unpack("<H", data[20:22])[0]
-        self.TriggerOffset = struct.unpack("<H", data[22:24])[0]
-        self.ErrorRetryCount = struct.unpack("<H", data[24:26])[0]
-        self.ErrorRetryInterval = struct.unpack("<H", data[26:28])[0]
-        self.IdleDeadline = struct.unpack("<H", data[28:30])[0]
-        self.IdleWait = struct.unpack("<H", data[30:32])[0]
-        self.Priority = struct.unpack(">I", data[32:36])[0]
-        self.MaxRunTime = struct.unpack("<i", data[36:40])[0]
-        self.ExitCode = struct.unpack("<I", data[40:44])[0]
-        self.Status = struct.unpack("<i", data[44:48])[0]
-        self.Flags = struct.unpack(">I", data[48:52])[0]
-        self.RunDate = JobDate(data[52:68])
+        fields = FIXED.unpack_from(self.buf)
+        self.ProductInfo, self.FileVersion = fields[:2]
+        self.UUID = UUID(fields[2:13])
+        (self.AppNameLenOffset, self.TriggerOffset, self.ErrorRetryCount, self.ErrorRetryInterval,
+                self.IdleDeadline, self.IdleWait, self.Priority, self.MaxRunTime, self.ExitCode,
+                self.Status, self.Flags) = fields[13:24]
+        self.Priority = swap32(self.Priority)
+        self.Flags = swap32(self.Flags)
+        self.RunDate = JobDate(fields[24:32])
+        self.RunningInstanceCount, self.NameLength = fields[32:34]
+
+    def _offsets(self):
         '''
         Variable length section
         http://msdn.microsoft.com/en-us/library/cc248287%28v=prot.10%29.aspx
+        Finds where each string starts without decoding any of them
         '''
-        self.RunningInstanceCount = struct.unpack("<H", data[68:70])[0]
-        self.NameLength = struct.unpack("<H", data[70:72])[0]
-        self.cursor = 72 + (self.NameLength * 2)
-        if self.NameLength > 0:
-            self.Name = data[72:self.cursor].replace('\x00', "")
-        self.ParameterSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Parameter = ""
-        if self.ParameterSize > 0:
-            self.Parameter = data[self.cursor:self.cursor + self.ParameterSize * 2].replace("\x00", "")
-            self.cursor += (self.ParameterSize * 2)
-        self.WorkingDirectorySize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.WorkingDirectory = "Working Directory not set"
-        if self.WorkingDirectorySize > 0:
-            self.WorkingDirectory = data[self.cursor:self.cursor + (self.WorkingDirectorySize * 2)].replace('\x00', "")
-            self.cursor += (self.WorkingDirectorySize * 2)
-        self.UserSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.User = "User not set"
-        if self.UserSize > 0:
-            self.User = data[self.cursor:self.cursor + self.UserSize * 2].replace("\x00", "")
-            self.cursor += (self.UserSize * 2)
-        self.CommentSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Comment = "Comment not set"
-        if self.CommentSize > 0:
-            self.Comment = data[self.cursor:self.cursor + self.CommentSize * 2].replace("\x00", "")
-            self.cursor += self.CommentSize * 2
-        self.UserDataSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        if self.UserDataSize > 0:
-            self.UserData = data[self.cursor:self.cursor + self.UserDataSize * 2].replace("\x00", "")
-            self.cursor += self.UserDataSize * 2
-        self.ReservedDataSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.StartError = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.TaskFlags = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.TriggerCount = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.TriggerSize = struct.unpack("<H",data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Reserved1 = struct.unpack("<H",data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.ScheduledStart = JobDate(data[self.cursor:self.cursor + 6], scheduled = True)
-        self.cursor += 6
-        self.ScheduledEnd = JobDate(data[self.cursor:self.cursor + 6], scheduled = True)
-        self.cursor += 6
-        self.StartHour = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.StartMinute = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.MinutesDuration = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.MinutesInterval = struct.unpack("<i",data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.TriggerFlag = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.TriggerType = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
-        self.cursor += 4
-        self.TriggerSpecific = TriggerFields(data[self.cursor:self.cursor + 6], self.TriggerType)
-        self.cursor += 6
-        self.Padding = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Reserved2 = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Reserved3 = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-        self.cursor += 2
-        self.Test = data[self.cursor:self.cursor + 2]
+        # the size of Name is NameLength from the fixed section
+        cursor = FIXED.size
+        self.offsets = [(cursor, self.NameLength)]
+        cursor += self.NameLength * 2
+        for name, sizename, empty in STRINGS[1:]:
+            size, = USHORT.unpack_from(self.buf, cursor)
+            setattr(self, sizename, size)
+            cursor += USHORT.size
+            self.offsets.append((cursor, size))
+            cursor += size * 2
+        # where the trigger starts, _trigger moves cursor on from here
+        self.start = cursor
+        self.cursor = cursor
+
+    def _string(self, index):
+        name, sizename, empty = STRINGS[index]
+        start, size = self.offsets[index]
+        if size > 0:
+            setattr(self, name, utf16(self.buf, start, size))
+        elif empty != None:
+            setattr(self, name, empty)
+
+    def _trigger(self):
+        cursor = self.start
+        (self.ReservedDataSize, self.StartError, self.TaskFlags, self.TriggerCount, self.TriggerSize,
+                self.Reserved1, sy, sm, sd, ey, em, ed, self.StartHour, self.StartMinute, self.MinutesDuration,
+                self.MinutesInterval, self.TriggerFlag, self.TriggerType) = TRIGGER.unpack_from(self.buf, cursor)
+        self.ScheduledStart = JobDate((sy, sm, sd), scheduled = True)
+        self.ScheduledEnd = JobDate((ey, em, ed), scheduled = True)
+        cursor += TRIGGER.size
+        self.Padding, self.Reserved2, self.Reserved3 = TRIGGERTAIL.unpack_from(self.buf, cursor)
+        self.TriggerSpecific = TriggerFields(self.buf, cursor, self.TriggerType)
+        cursor += TRIGGERTAIL.size
+        self.Test = self.buf[cursor:cursor + 2].tobytes()
         if self.Test != '' and self.TriggerCount == 1:
-            self.SignatureVersion = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-            self.cursor += 2
-            self.MinClientVersion = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
-            self.cursor += 2
-            self.JobSignature = data[self.cursor:self.cursor + 64]
+            self.SignatureVersion, self.MinClientVersion = SIGNATURE.unpack_from(self.buf, cursor)
+            cursor += SIGNATURE.size
+            self.JobSignature = self.buf[cursor:cursor + 64].tobytes()
+        self.cursor = cursor
 
     def _get_job_info(self):
-        lines = []
-        lines.append("Product Info: {0}".format(products.get(self.ProductInfo, "Unknown Version")))
-        lines.append("File Version: {0}".format(self.FileVersion))
-        lines.append("UUID: {0}".format(self.UUID))
-        lines.append("Error Retry Count: {0}".format(self.ErrorRetryCount))
-        lines.append("Error Retry Interval: {0}".format(self.ErrorRetryInterval))
-        lines.append("Idle Deadline: {0}".format(self.IdleDeadline))
-        lines.append("Idle Wait: {0}".format(self.IdleWait))
-        priority = ""
-        for p in priorities:
-            if self.Priority & p == p:
-                priority += priorities[p] + ", "
-        if priority != "": 
-            lines.append("Priorities: {0}".format(priority.rstrip(", ")))
-        hours, ms = divmod(self.MaxRunTime, 3600000)
-        minutes, ms = divmod(ms, 60000)
-        seconds = ms / 1000
-        lines.append("Maximum Run Time: {0:02}:{1:02}:{2:02}.{3} (HH:MM:SS.MS)".format(hours, minutes, seconds, ms))
-        ecode = ""
-        for e in exitcode:
-            if self.ExitCode == e:
-                ecode = exitcode[e]
-        lines.append("Exit Code: {0}".format(ecode))
-        lines.append("Status: {0}".format(task_status.get(self.Status, "Unknown Status")))
-        theflags = ""
-        for flag in flags:
-            if self.Flags & flag == flag:
-                theflags += flags[flag] + ", "
-        lines.append("Flags: {0}".format(theflags.rstrip(", ")))
-        lines.append("Date Run: {0}".format(self.RunDate))
-        lines.append("Running Instances: {0}".format(self.RunningInstanceCount))
-        lines.append("Application: {0}".format(self.Name))
-        if self.Parameter != "": 
-            lines.append("Parameters: {0}".format(self.Parameter))
-        lines.append("Working Directory: {0}".format(self.WorkingDirectory))
-        lines.append("User: {0}".format(self.User))
-        lines.append("Comment: {0}".format(self.Comment))
-        for e in exitcode:
-            if self.StartError == e:
-                serror = exitcode[e]
-        lines.append("Start Error: {0}".format(serror))
-        lines.appensd("Trigger Count: {0}".format(self.TriggerCount))
-        lines.append("Scheduled Start Date: {0}".format(self.ScheduledStart))
-        lines.append("Scheduled End Date: {0}".format(self.ScheduledEnd))
-        lines.append("Start Hour: {0}".format(self.StartHour))
-        lines.append("Start Minute: {0}".format(self.StartMinute))
-        lines.append("Minutes Duration: {0}".format(self.MinutesDuration))
-        lines.append("Minutes Interval: {0}".format(self.MinutesInterval))
-        tflags = ""
-        for flag in triggerflags:
-            if self.TriggerFlag & flag == flag:
-                tflags += triggerflags[flag] + ","
-        lines.append("Trigger Flags: {0}".format(tflags.rstrip(", ")))
-        ttype = ""
-        for type in triggertype:
-            if self.TriggerType & type == type:
-                ttype += triggertype[type] + ","
-        lines.append("Trigger Type: {0}\n".format(ttype.rstrip(", ")))
-        if self.TriggerSpecific != "":
-            lines.append("{0}".format(self.TriggerSpecific))
-        if self.Test != '':
-            str = ""
-            for ch in self.JobSignature:
-                str += hex(ord(ch)).lstrip("0x")
-            lines.append("Job Signature: {0}".format(str))
-        return lines
+        return [u"%s: %s" % item for item in JobItems(self)]
 
     def __repr__(self):
-        lines = ""
-        lines += "Product Info: {0}\n".format(products.get(self.ProductInfo, "None"))
-        lines += "File Version: {0}\n".format(self.FileVersion)
-        lines += "UUID: {0}\n".format(self.UUID)
-        lines += "Error Retry Count: {0}\n".format(self.ErrorRetryCount)
-        lines += "Error Retry Interval: {0}\n".format(self.ErrorRetryInterval)
-        lines += "Idle Deadline: {0}\n".format(self.IdleDeadline)
-        lines += "Idle Wait: {0}\n".format(self.IdleWait)
-        priority = ""
-        for p in priorities:
-            if self.Priority & p == p:
-                priority += priorities[p] + ", "
-        if priority != "":
-            lines += "Priorities: {0}\n".format(priority.rstrip(", "))
-        hours, ms = divmod(self.MaxRunTime, 3600000)
-        minutes, ms = divmod(ms, 60000)
-        seconds = ms / 1000
-        lines += "Maximum Run Time: {0:02}:{1:02}:{2:02}.{3} (HH:MM:SS.MS)\n".format(hours, minutes, seconds, ms)
-        for e in exitcode:
-            if self.ExitCode == e:
-                ecode = exitcode[e]
-        lines += "Exit Code: {0}\n".format(ecode)
-        lines += "Status: {0}\n".format(task_status.get(self.Status, "Unknown Status"))
-        theflags = ""
-        for flag in flags:
-            if self.Flags & flag == flag:
-                theflags += flags[flag] + ", "
-        lines += "Flags: {0}\n".format(theflags.rstrip(", "))
-        lines += "Date Run: {0}\n".format(self.RunDate)
-        lines += "Running Instances: {0}\n".format(self.RunningInstanceCount)
-        lines += "Application: {0}\n".format(self.Name)
-        if self.Parameter != "":
-            lines += "Parameters: {0}\n".format(self.Parameter)
-        lines += "Working Directory: {0}\n".format(self.WorkingDirectory)
-        lines += "User: {0}\n".format(self.User)
-        lines += "Comment: {0}\n".format(self.Comment)
-        for e in exitcode:
-            if self.StartError == e:
-                serror = exitcode[e]
-        lines += "Start Error: {0}\n".format(serror)
-        lines += "Trigger Count: {0}\n".format(self.TriggerCount)
-        lines += "Scheduled Start Date: {0}\n".format(self.ScheduledStart)
-        lines += "Scheduled End Date: {0}\n".format(self.ScheduledEnd)
-        lines += "Start Hour: {0}\n".format(self.StartHour)
-        lines += "Start Minute: {0}\n".format(self.StartMinute)
-        lines += "Minutes Duration: {0}\n".format(self.MinutesDuration)
-        lines += "Minutes Interval: {0}\n".format(self.MinutesInterval)
-        tflags = ""
-        for flag in triggerflags:
-            if self.TriggerFlag & flag == flag:
-                tflags += triggerflags[flag] + ","
-        lines += "Trigger Flags: {0}\n".format(tflags.rstrip(", "))
-        ttype = ""
-        for type in triggertype:
-            if self.TriggerType & type == type:
-                ttype = triggertype[type]
-        lines += "Trigger Type: {0}\n".format(ttype)
-        if self.TriggerSpecific != "":
-            lines += "{0}".format(self.TriggerSpecific)
-        if self.Test != '':
-            str = ""
-            for ch in self.JobSignature:
-                str += hex(ord(ch)).lstrip("0x")
-            lines += "Job Signature: {0}\n".format(str)
-        return lines
-        
+        return JobText(self).encode("utf-8")
+
+# http://msdn.microsoft.com/en-us/library/cc248285%28PROT.10%29.aspx
+class Job(JobBase):
+    __slots__ = ()
+
+    def __init__(self, data):
+        # decodes everything in one pass, the strings are read in line
+        # rather than through the STRINGS table JobView uses to find each one
+        buf = self.buf = memoryview(data)
+        self._fixed()
+        cursor = FIXED.size
+        size = self.NameLength
+        if size > 0:
+            self.Name = utf16(buf, cursor, size)
+        cursor += size * 2
+        self.ParameterSize = size = USHORT.unpack_from(buf, cursor)[0]
+        cursor += 2
+        self.Parameter = utf16(buf, cursor, size) if size > 0 else ""
+        cursor += size * 2
+        self.WorkingDirectorySize = size = USHORT.unpack_from(buf, cursor)[0]
+        cursor += 2
+        self.WorkingDirectory = utf16(buf, cursor, size) if size > 0 else "Working Directory not set"
+        cursor += size * 2
+        self.UserSize = size = USHORT.unpack_from(buf, cursor)[0]
+        cursor += 2
+        self.User = utf16(buf, cursor, size) if size > 0 else "User not set"
+        cursor += size * 2
+        self.CommentSize = size = USHORT.unpack_from(buf, cursor)[0]
+        cursor += 2
+        self.Comment = utf16(buf, cursor, size) if size > 0 else "Comment not set"
+        cursor += size * 2
+        self.UserDataSize = size = USHORT.unpack_from(buf, cursor)[0]
+        cursor += 2
+        if size > 0:
+            self.UserData = utf16(buf, cursor, size)
+        cursor += size * 2
+        self.start = cursor
+        self._trigger()
+
+# which JobBase method fills in each field
+LAZYFIELDS = {}
+for name in JOBFIELDS[:JOBFIELDS.index("cursor")]:
+    LAZYFIELDS[name] = (JobBase._fixed,)
+for name in ("offsets", "start", "cursor") + tuple(sizename for name, sizename, empty in STRINGS[1:]):
+    LAZYFIELDS[name] = (JobBase._offsets,)
+for index, (name, sizename, empty) in enumerate(STRINGS):
+    LAZYFIELDS[name] = (JobBase._string, index)
+for name in JOBFIELDS[JOBFIELDS.index("ReservedDataSize"):]:
+    LAZYFIELDS[name] = (JobBase._trigger,)
+
+class JobView(JobBase):
+    '''
+    A Job that decodes nothing until a field is read: the fixed section is
+    unpacked on first use of any of its fields, the string offsets and the
+    trigger on first use of theirs, and each string is only decoded from
+    UTF-16 when it is read.  Filtering a large set of jobs on one field
+    only pays for that field
+    '''
+    __slots__ = ()
+
+    def __init__(self, data):
+        self.buf = memoryview(data)
+        self.loaded = set()
+
+    def __getattr__(self, name):
+        # only called for fields that are not set yet.  Each loader runs
+        # once, fields it leaves unset (Name, UserData, the signature) stay
+        # missing instead of parsing that part again
+        loader = LAZYFIELDS.get(name)
+        if loader == None or loader in self.loaded:
+            raise AttributeError(name)
+        loader[0](self, *loader[1:])
+        self.loaded.add(loader)
+        return object.__getattribute__(self, name)
+
+class BitNames(object):
+    '''
+    Names of the bits set in a value from one of the flag tables above.
+    Job sets repeat a handful of values, so each is only worked out once
+    '''
+    def __init__(self, table, sep):
+        self.items = table.items()
+        self.sep = sep
+        self.cache = {}
+
+    def __call__(self, value):
+        names = self.cache.get(value)
+        if names == None:
+            names = self.sep.join(name for bit, name in self.items if value & bit == bit)
+            self.cache[value] = names
+        return names
+
+prioritynames = BitNames(priorities, ", ")
+flagnames = BitNames(flags, ", ")
+triggerflagnames = BitNames(triggerflags, ",")
+
+def _runtime(job):
+    hours, ms = divmod(job.MaxRunTime, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds = ms / 1000
+    return "{0:02}:{1:02}:{2:02}.{3} (HH:MM:SS.MS)".format(hours, minutes, seconds, ms)
+
+# (label, value, left out when empty) in display order
+FIELDS = [
+    ("Product Info", lambda job: products.get(job.ProductInfo, "None"), False),
+    ("File Version", attrgetter("FileVersion"), False),
+    ("UUID", attrgetter("UUID"), False),
+    ("Error Retry Count", attrgetter("ErrorRetryCount"), False),
+    ("Error Retry Interval", attrgetter("ErrorRetryInterval"), False),
+    ("Idle Deadline", attrgetter("IdleDeadline"), False),
+    ("Idle Wait", attrgetter("IdleWait"), False),
+    ("Priorities", lambda job: prioritynames(job.Priority), True),
+    ("Maximum Run Time", _runtime, False),
+    ("Exit Code", lambda job: exitcode.get(job.ExitCode, ""), False),
+    ("Status", lambda job: task_status.get(job.Status, "Unknown Status"), False),
+    ("Flags", lambda job: flagnames(job.Flags), False),
+    ("Date Run", attrgetter("RunDate"), False),
+    ("Running Instances", attrgetter("RunningInstanceCount"), False),
+    ("Application", lambda job: getattr(job, "Name", ""), False),
+    ("Parameters", attrgetter("Parameter"), True),
+    ("Working Directory", attrgetter("WorkingDirectory"), False),
+    ("User", attrgetter("User"), False),
+    ("Comment", attrgetter("Comment"), False),
+    ("Start Error", lambda job: exitcode.get(job.StartError, ""), False),
+    ("Trigger Count", attrgetter("TriggerCount"), False),
+    ("Scheduled Start Date", attrgetter("ScheduledStart"), False),
+    ("Scheduled End Date", attrgetter("ScheduledEnd"), False),
+    ("Start Hour", attrgetter("StartHour"), False),
+    ("Start Minute", attrgetter("StartMinute"), False),
+    ("Minutes Duration", attrgetter("MinutesDuration"), False),
+    ("Minutes Interval", attrgetter("MinutesInterval"), False),
+    ("Trigger Flags", lambda job: triggerflagnames(job.TriggerFlag), False),
+    ("Trigger Type", lambda job: triggertype.get(job.TriggerType, ""), False),
+]
+FIELDMAP = dict((label, value) for label, value, optional in FIELDS)
+
+def JobItems(job):
+    items = []
+    for label, value, optional in FIELDS:
+        value = value(job)
+        if optional and value == "":
+            continue
+        items.append((label, value))
+    items.extend(job.TriggerSpecific.items())
+    if job.Test != '' and getattr(job, "JobSignature", None) != None:
+        items.append(("Job Signature", binascii.hexlify(job.JobSignature)))
+    return items
+
+def JobText(job):
+    return u"".join([u"%s: %s\n" % item for item in JobItems(job)])
+
+def JobJSON(job, path = None):
+    record = collections.OrderedDict()
+    if path != None:
+        record["File"] = path
+    for label, value in JobItems(job):
+        if not isinstance(value, (int, long, basestring)):
+            value = str(value)
+        record[label] = value
+    return json.dumps(record)
+
+def JobMatches(job, filters):
+    # filters is a list of (label, compiled regex), all have to match
+    for label, regex in filters:
+        if regex.search(u"%s" % FIELDMAP[label](job)) == None:
+            return False
+    return True
+
+def ReadJob(path):
+    # job files are a few hundred bytes, a bounded read is all they need
+    with open(path, "rb") as f:
+        return f.read(MAXJOBSIZE)
+
+def _error(stage, e):
+    name = type(e).__name__
+    if type(e).__module__ not in ("exceptions", "__builtin__"):
+        name = type(e).__module__ + "." + name
+    return (stage, name, str(e))
+
+def JobFilters(specs):
+    '''
+    "Field=regex" strings to (label, compiled regex)
+    '''
+    filters = []
+    for spec in specs:
+        label, sep, pattern = spec.partition("=")
+        if sep == "" or label not in FIELDMAP:
+            raise ValueError("bad filter {0}, fields are: {1}".format(spec, ", ".join(label for label, value, optional in FIELDS)))
+        filters.append((label, re.compile(pattern, re.IGNORECASE)))
+    return filters
+
+# set in each worker by _init_worker
+_filters = []
+_asjson = False
+
+def _init_worker(filters, asjson):
+    global _filters, _asjson
+    _filters = JobFilters(filters)
+    _asjson = asjson
+
+def _parse_job(path):
+    '''
+    Pool worker, returns (path, bytes read, job text, error).  error is None
+    or (stage, exception type, message), job text and error are both None
+    for jobs the filters leave out.  Only the fields the filters look at are
+    decoded for jobs that get left out, without filters every job is printed
+    in full and Job decodes it in one pass
+    '''
+    try:
+        data = ReadJob(path)
+    except (IOError, OSError), e:
+        return (path, 0, None, _error("read", e))
+    try:
+        if _filters:
+            job = JobView(data)
+        else:
+            job = Job(data)
+        if not JobMatches(job, _filters):
+            return (path, len(data), None, None)
+        if _asjson:
+            return (path, len(data), JobJSON(job, path), None)
+        return (path, len(data), JobText(job).encode("utf-8"), None)
+    except Exception, e:
+        return (path, len(data), None, _error("parse", e))
+
+def FindJobs(dir, recurse = False):
+    paths = []
+    if recurse:
+        for root, dirs, files in os.walk(dir):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname.lower().endswith(".job"):
+                    paths.append(os.path.join(root, fname))
+    else:
+        for fname in sorted(os.listdir(dir)):
+            if fname.lower().endswith(".job") and os.path.isfile(os.path.join(dir, fname)):
+                paths.append(os.path.join(dir, fname))
+    return paths
+
+def ParseJobs(paths, workers = None, filters = [], asjson = False):
+    '''
+    Yields _parse_job results in the order of paths.  The files are read
+    and parsed by a pool of worker processes, handed out in chunks.
+    filters are "Field=regex" strings
+    '''
+    if workers == 1 or len(paths) < 2:
+        _init_worker(filters, asjson)
+        for path in paths:
+            yield _parse_job(path)
+        return
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes = workers, initializer = _init_worker, initargs = (filters, asjson))
+    try:
+        for result in pool.imap(_parse_job, paths, chunksize = max(1, min(256, len(paths) / (4 * workers)))):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def usage():
     print "jobparser.py:\n"
     print " -f <job>"
     print " -d <directory of job files>"
+    print " -r [optional: also look for job files in subdirectories of -d (one per host)]"
+    print " -w <number of worker processes for -d (default number of CPUs)>"
+    print " -e <csv report of the files that could not be parsed>"
+    print " -j [optional: one JSON object per job instead of text]"
+    print " -m <Field=regex: only show jobs whose field matches, e.g. Application=evil\\.exe"
+    print "     (case insensitive, can be given more than once, all have to match)>"
 
 def main():
     file = None
     dir = None
+    recurse = False
+    workers = None
+    report = None
+    asjson = False
+    filters = []
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hf:d:", ["help", "file=", "dir="])
+        opts, args = getopt.getopt(sys.argv[1:], "hf:d:rw:e:jm:", ["help", "file=", "dir=", "recurse", "workers=", "errors=",
+            "json", "match="])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
@@ -501,13 +676,23 @@ def main():
             sys.exit(2)
         elif o in ("-f", "--file"):
             if os.path.isfile(a):
-                file = open(a, "rb")
+                file = a
             else:
                 print a + " is not a file"
                 usage()
                 return
         elif o in ("-d", "--dir"):
             dir = a
+        elif o in ("-r", "--recurse"):
+            recurse = True
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-e", "--errors"):
+            report = a
+        elif o in ("-j", "--json"):
+            asjson = True
+        elif o in ("-m", "--match"):
+            filters.append(a)
         else:
             assert False, "unhandled option\n\n"
             sys.exit(2)
@@ -515,29 +700,59 @@ def main():
     if file == None and dir == None:
         usage()
         return
+    try:
+        JobFilters(filters)
+    except (ValueError, re.error), e:
+        print str(e)
+        sys.exit(2)
     
     if dir != None and os.path.isdir(dir):
-        for fname in os.listdir(dir):
-            if fname.endswith(".job") and os.path.isfile(os.path.join(dir, fname)):
-                file = open(os.path.join(dir, fname), "rb")
-                try:
-                    job = Job(file.read(0x2000))
-                    print "*" * 72
-                    print "File: " + os.path.join(dir, fname)
-                    print job
-                    print "*" * 72
-                except:
-                    print "Unable to process file: " + os.path.join(dir, fname)
-
-        file = None
-
-
-    # I'm not sure what's the largest a job file can be, but I'm setting a limit 
-    # just to avoid accidental imports of large files
+        start = time.time()
+        paths = FindJobs(dir, recurse)
+        found = time.time() - start
+        errors = []
+        total = 0
+        shown = 0
+        for path, size, text, error in ParseJobs(paths, workers, filters, asjson):
+            total += size
+            if error != None:
+                if not asjson:
+                    print "Unable to process file: {0} ({1}: {2})".format(path, error[1], error[2])
+                errors.append([path, size] + list(error))
+                continue
+            if text == None:
+                continue
+            shown += 1
+            if asjson:
+                print text
+                continue
+            print "*" * 72
+            print "File: " + path
+            print text
+            print "*" * 72
+        elapsed = time.time() - start
+
+        if report != None:
+            with open(report, "wb") as f:
+                writer = csv.writer(f)
+                writer.writerow(["File", "Bytes", "Stage", "Error", "Message"])
+                writer.writerows(errors)
+        kinds = {}
+        for error in errors:
+            kinds[error[3]] = kinds.get(error[3], 0) + 1
+        sys.stderr.write("{0} job files ({1} bytes) in {2:.2f}s, {3:.2f}s finding them: {4:.0f} files/sec\n".format(
+            len(paths), total, elapsed, found, len(paths) / max(elapsed, 1e-6)))
+        sys.stderr.write("{0} parsed, {1} failed{2}{3}\n".format(len(paths) - len(errors), len(errors),
+            "".join(", {0} {1}".format(n, kind) for kind, n in sorted(kinds.items())),
+            ", {0} matched".format(shown) if filters else ""))
+
     elif file != None:
-        data = file.read(0x2000)
-        job = Job(data)
-        print job
+        job = JobView(ReadJob(file))
+        if JobMatches(job, JobFilters(filters)):
+            if asjson:
+                print JobJSON(job, file)
+            else:
+                print JobText(job).encode("utf-8")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+import sys
+import os
+import getopt
+import struct
+import random
+import time
+
+import jobparser
+from jobparser import Job, JobView, JobText, JobMatches, JobFilters, FindJobs, ReadJob
+from jobparser import weekdays, months, products, priorities, exitcode, task_status, flags, triggerflags, triggertype
+
+"""
+Author: Gleeda <jamie.levy@gmail.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version
+2 of the License, or (at your option) any later version.
+
+jobparser_bench.py
+    Times jobparser.Job against the parser it replaced (kept below as
+    LegacyJob, it slices and unpacks every field separately) and checks
+    both read the same values, then times printing every job (Job, as
+    jobparser does without filters) and filtering on the application with
+    jobparser.JobView.  Without -d the job files
+    are synthetic and generated from a fixed seed
+
+     -d <directory of job files, searched recursively>
+     -n <number of synthetic job files (default 20000)>
+     -r <passes over the job files (default 5)>
+"""
+
+def usage():
+    print "jobparser_bench.py:\n"
+    print " -d <directory of job files, searched recursively>"
+    print " -n <number of synthetic job files (default 20000)>"
+    print " -r <passes over the job files (default 5)>"
+
+# the parser and text output as they were before jobparser used precompiled
+# structs and the JobView emitter
+class LegacyJobDate:
+    def __init__(self, data, scheduled = False):
+        # scheduled is the time the job was scheduled to run
+        self.scheduled = scheduled
+        self.Year = struct.unpack("<H", data[:2])[0]
+        self.Month = struct.unpack("<H", data[2:4])[0]
+        if not self.scheduled:
+            self.Weekday = struct.unpack("<H", data[4:6])[0]
+            self.Day = struct.unpack("<H", data[6:8])[0]
+            self.Hour = struct.unpack("<H", data[8:10])[0]
+            self.Minute = struct.unpack("<H", data[10:12])[0]
+            self.Second = struct.unpack("<H", data[12:14])[0]
+            self.Milliseconds = struct.unpack("<H", data[14:16])[0]
+        else:
+            self.Weekday = None
+            self.Day = struct.unpack("<H", data[4:6])[0]
+            self.Hour = 00
+            self.Minute = 00
+            self.Second = 00
+            self.Milliseconds = 00
+
+    def __repr__(self):
+        day = weekdays.get(self.Weekday, None)
+        mon = months.get(self.Month, None)
+        if day != None and mon != None and not self.scheduled:
+            return "{0} {1} {2} {3:02}:{4:02}:{5:02}.{6} {7}".format(day, mon, self.Day, self.Hour, self.Minute, self.Second, self.Milliseconds, self.Year)
+        elif self.scheduled and mon == None:
+            return "Does not expire"
+        elif self.scheduled:
+            return "{0} {1} {2:02}:{3:02}:{4:02}.{5} {6}".format(mon, self.Day, self.Hour, self.Minute, self.Second, self.Milliseconds, self.Year)
+        return "Task not yet run"
+
+
+# http://msdn.microsoft.com/en-us/library/aa379358%28v=vs.85%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc248286%28v=prot.10%29.aspx
+class LegacyUUID:
+    def __init__(self, data):
+        self.UUID0 = struct.unpack("<I", data[:4])[0]
+        self.UUID1 = struct.unpack("<H", data[4:6])[0]
+        self.UUID2 = struct.unpack("<H", data[6:8])[0]
+        self.UUID3 = struct.unpack(">H", data[8:10])[0]
+        self.UUID4 = struct.unpack(">H", data[10:12])[0]
+        self.UUID5 = struct.unpack(">H", data[12:14])[0]
+        self.UUID6 = struct.unpack(">H", data[14:16])[0]
+
+    def __repr__(self):
+        return "{" + "{0:08X}-{1:04X}-{2:04X}-{3:04X}-{4:02X}{5:02X}{6:02X}".format(self.UUID0, self.UUID1, self.UUID2, 
+                self.UUID3, self.UUID4, self.UUID5, self.UUID6) + "}"
+
+
+class LegacyTriggerFields:
+    def __init__(self, data, ttype):
+        self.ttype = ttype
+        if self.ttype == 1:
+            self.DaysInterval = struct.unpack("<H", data[:2])[0]
+        elif self.ttype == 2:
+            self.WeeksInterval = struct.unpack("<H", data[:2])[0]
+            self.DaysOfTheWeek = struct.unpack("<H", data[2:4])[0]
+        elif self.ttype == 3:
+            self.Days = struct.unpack("<I", data[:4])[0]
+            self.Months = struct.unpack("<H", data[4:6])[0]
+        elif self.ttype == 4:
+            self.WhichWeek = struct.unpack("<H", data[:2])[0]
+            self.DaysOfTheWeek = struct.unpack("<H", data[2:4])[0]
+            self.Months = struct.unpack("<H", data[4:6])[0]
+
+    def __repr__(self):
+        if self.ttype == 1:
+            return "Days Interval: {0}\n".format(self.DaysInterval)
+        elif self.ttype == 2:
+            return "Weeks Interval: {0}\nDays Of The Week: {1}\n".format(self.WeeksInterval, self.DaysOfTheWeek)
+        elif self.ttype == 3:
+            return "Days: {0}\nMonths: {1}\n".format(self.Days, self.Months)
+        elif self.ttype == 4:
+            return "Which Week: {0}\nDays Of The Week: {1}\nMonths: {2}\n".format(self.WhichWeek, self.DaysOfTheWeek, self.Months)
+        return ""
+
+
+# http://msdn.microsoft.com/en-us/library/cc248285%28PROT.10%29.aspx
+class LegacyJob:
+    def __init__(self, data):
+        '''
+        Fixed length section
+        http://msdn.microsoft.com/en-us/library/cc248286%28v=prot.13%29.aspx
+        '''
+        self.ProductInfo = struct.unpack("<H", data[:2])[0]
+        self.FileVersion = struct.unpack("<H", data[2:4])[0]
+        self.UUID = LegacyUUID(data[4:20])
+        self.AppNameLenOffset = struct.unpack("<H", data[20:22])[0]
+        self.TriggerOffset = struct.unpack("<H", data[22:24])[0]
+        self.ErrorRetryCount = struct.unpack("<H", data[24:26])[0]
+        self.ErrorRetryInterval = struct.unpack("<H", data[26:28])[0]
+        self.IdleDeadline = struct.unpack("<H", data[28:30])[0]
+        self.IdleWait = struct.unpack("<H", data[30:32])[0]
+        self.Priority = struct.unpack(">I", data[32:36])[0]
+        self.MaxRunTime = struct.unpack("<i", data[36:40])[0]
+        self.ExitCode = struct.unpack("<I", data[40:44])[0]
+        self.Status = struct.unpack("<i", data[44:48])[0]
+        self.Flags = struct.unpack(">I", data[48:52])[0]
+        self.RunDate = LegacyJobDate(data[52:68])
+        '''
+        Variable length section
+        http://msdn.microsoft.com/en-us/library/cc248287%28v=prot.10%29.aspx
+        '''
+        self.RunningInstanceCount = struct.unpack("<H", data[68:70])[0]
+        self.NameLength = struct.unpack("<H", data[70:72])[0]
+        self.cursor = 72 + (self.NameLength * 2)
+        if self.NameLength > 0:
+            self.Name = data[72:self.cursor].replace('\x00', "")
+        self.ParameterSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Parameter = ""
+        if self.ParameterSize > 0:
+            self.Parameter = data[self.cursor:self.cursor + self.ParameterSize * 2].replace("\x00", "")
+            self.cursor += (self.ParameterSize * 2)
+        self.WorkingDirectorySize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.WorkingDirectory = "Working Directory not set"
+        if self.WorkingDirectorySize > 0:
+            self.WorkingDirectory = data[self.cursor:self.cursor + (self.WorkingDirectorySize * 2)].replace('\x00', "")
+            self.cursor += (self.WorkingDirectorySize * 2)
+        self.UserSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.User = "User not set"
+        if self.UserSize > 0:
+            self.User = data[self.cursor:self.cursor + self.UserSize * 2].replace("\x00", "")
+            self.cursor += (self.UserSize * 2)
+        self.CommentSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Comment = "Comment not set"
+        if self.CommentSize > 0:
+            self.Comment = data[self.cursor:self.cursor + self.CommentSize * 2].replace("\x00", "")
+            self.cursor += self.CommentSize * 2
+        self.UserDataSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        if self.UserDataSize > 0:
+            self.UserData = data[self.cursor:self.cursor + self.UserDataSize * 2].replace("\x00", "")
+            self.cursor += self.UserDataSize * 2
+        self.ReservedDataSize = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.StartError = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.TaskFlags = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.TriggerCount = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.TriggerSize = struct.unpack("<H",data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Reserved1 = struct.unpack("<H",data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.ScheduledStart = LegacyJobDate(data[self.cursor:self.cursor + 6], scheduled = True)
+        self.cursor += 6
+        self.ScheduledEnd = LegacyJobDate(data[self.cursor:self.cursor + 6], scheduled = True)
+        self.cursor += 6
+        self.StartHour = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.StartMinute = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.MinutesDuration = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.MinutesInterval = struct.unpack("<i",data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.TriggerFlag = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.TriggerType = struct.unpack("<i", data[self.cursor:self.cursor + 4])[0]
+        self.cursor += 4
+        self.TriggerSpecific = LegacyTriggerFields(data[self.cursor:self.cursor + 6], self.TriggerType)
+        self.cursor += 6
+        self.Padding = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Reserved2 = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Reserved3 = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+        self.cursor += 2
+        self.Test = data[self.cursor:self.cursor + 2]
+        if self.Test != '' and self.TriggerCount == 1:
+            self.SignatureVersion = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+            self.cursor += 2
+            self.MinClientVersion = struct.unpack("<H", data[self.cursor:self.cursor + 2])[0]
+            self.cursor += 2
+            self.JobSignature = data[self.cursor:self.cursor + 64]
+
+    def __repr__(self):
+        lines = ""
+        lines += "Product Info: {0}\n".format(products.get(self.ProductInfo, "None"))
+        lines += "File Version: {0}\n".format(self.FileVersion)
+        lines += "UUID: {0}\n".format(self.UUID)
+        lines += "Error Retry Count: {0}\n".format(self.ErrorRetryCount)
+        lines += "Error Retry Interval: {0}\n".format(self.ErrorRetryInterval)
+        lines += "Idle Deadline: {0}\n".format(self.IdleDeadline)
+        lines += "Idle Wait: {0}\n".format(self.IdleWait)
+        priority = ""
+        for p in priorities:
+            if self.Priority & p == p:
+                priority += priorities[p] + ", "
+        if priority != "":
+            lines += "Priorities: {0}\n".format(priority.rstrip(", "))
+        hours, ms = divmod(self.MaxRunTime, 3600000)
+        minutes, ms = divmod(ms, 60000)
+        seconds = ms / 1000
+        lines += "Maximum Run Time: {0:02}:{1:02}:{2:02}.{3} (HH:MM:SS.MS)\n".format(hours, minutes, seconds, ms)
+        for e in exitcode:
+            if self.ExitCode == e:
+                ecode = exitcode[e]
+        lines += "Exit Code: {0}\n".format(ecode)
+        lines += "Status: {0}\n".format(task_status.get(self.Status, "Unknown Status"))
+        theflags = ""
+        for flag in flags:
+            if self.Flags & flag == flag:
+                theflags += flags[flag] + ", "
+        lines += "Flags: {0}\n".format(theflags.rstrip(", "))
+        lines += "Date Run: {0}\n".format(self.RunDate)
+        lines += "Running Instances: {0}\n".format(self.RunningInstanceCount)
+        lines += "Application: {0}\n".format(self.Name)
+        if self.Parameter != "":
+            lines += "Parameters: {0}\n".format(self.Parameter)
+        lines += "Working Directory: {0}\n".format(self.WorkingDirectory)
+        lines += "User: {0}\n".format(self.User)
+        lines += "Comment: {0}\n".format(self.Comment)
+        for e in exitcode:
+            if self.StartError == e:
+                serror = exitcode[e]
+        lines += "Start Error: {0}\n".format(serror)
+        lines += "Trigger Count: {0}\n".format(self.TriggerCount)
+        lines += "Scheduled Start Date: {0}\n".format(self.ScheduledStart)
+        lines += "Scheduled End Date: {0}\n".format(self.ScheduledEnd)
+        lines += "Start Hour: {0}\n".format(self.StartHour)
+        lines += "Start Minute: {0}\n".format(self.StartMinute)
+        lines += "Minutes Duration: {0}\n".format(self.MinutesDuration)
+        lines += "Minutes Interval: {0}\n".format(self.MinutesInterval)
+        tflags = ""
+        for flag in triggerflags:
+            if self.TriggerFlag & flag == flag:
+                tflags += triggerflags[flag] + ","
+        lines += "Trigger Flags: {0}\n".format(tflags.rstrip(", "))
+        ttype = ""
+        for type in triggertype:
+            if self.TriggerType & type == type:
+                ttype = triggertype[type]
+        lines += "Trigger Type: {0}\n".format(ttype)
+        if self.TriggerSpecific != "":
+            lines += "{0}".format(self.TriggerSpecific)
+        if self.Test != '':
+            str = ""
+            for ch in self.JobSignature:
+                str += hex(ord(ch)).lstrip("0x")
+            lines += "Job Signature: {0}\n".format(str)
+        return lines
+
+
+def _utf16(s):
+    if s == "":
+        return struct.pack("<H", 0)
+    return struct.pack("<H", len(s) + 1) + (s + "\x00").encode("utf-16-le")
+
+def synthetic(count, seed = 1):
+    r = random.Random(seed)
+    jobs = []
+    for i in xrange(count):
+        ttype = r.randint(0, 7)
+        data = struct.pack("<HH", r.choice([0x501, 0x601, 0x603]), 1)
+        data += "".join(chr(r.randint(0, 255)) for j in xrange(16))
+        data += struct.pack("<6H", 0x46, 0x100, 3, 10, 10, 60)
+        data += struct.pack(">I", r.choice([0x20000000, 0x40000000])) + struct.pack("<iIi", 259200000, 0, 0x41303)
+        data += struct.pack(">I", r.choice([0x100000, 0x4000000, 0x20000]))
+        data += struct.pack("<8H", 2015, r.randint(1, 12), r.randint(0, 6), r.randint(1, 28), 10, 30, 5, 100)
+        data += struct.pack("<H", 1) + _utf16("C:\\Temp\\task%d.exe" % r.randint(0, 999))
+        data += _utf16(r.choice(["", "/c whoami"])) + _utf16("C:\\Temp") + _utf16("SYSTEM")
+        data += _utf16("Created by NetScheduleJobAdd.")
+        data += struct.pack("<HH", 0, 8) + struct.pack("<iI", 0x41303, 0)
+        data += struct.pack("<HHH", 1, 0x30, 0) + struct.pack("<3H", 2015, 3, 2) + struct.pack("<3H", 0, 0, 0)
+        data += struct.pack("<HHiiii", 17, 11, 0, 0, r.randint(0, 7), ttype)
+        data += struct.pack("<3H", r.randint(1, 4), 0x7f, 0xfff) + struct.pack("<3H", 0, 0, 0)
+        if r.random() < 0.5:
+            data += struct.pack("<HH", 1, 1) + "".join(chr(r.randint(0, 255)) for j in xrange(64))
+        jobs.append(data)
+    return jobs
+
+def fields(job):
+    values = []
+    for name in jobparser.JOBFIELDS:
+        value = getattr(job, name, None)
+        if hasattr(value, "__slots__") or hasattr(value, "__dict__"):
+            # JobDate, UUID and TriggerFields, compared by the new class' fields
+            cls = getattr(jobparser, value.__class__.__name__.replace("Legacy", ""))
+            value = tuple(getattr(value, n, None) for n in cls.__slots__)
+        values.append(value)
+    return values
+
+def timeit(name, parser, jobs, passes):
+    start = time.time()
+    for i in xrange(passes):
+        for data in jobs:
+            parser(data)
+    elapsed = time.time() - start
+    rate = len(jobs) * passes / elapsed
+    print "{0:24} {1:8.2f}s {2:12.0f} jobs/sec".format(name, elapsed, rate)
+    return rate
+
+def main():
+    dir = None
+    count = 20000
+    passes = 5
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:n:r:", ["help", "dir=", "count=", "passes="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-d", "--dir"):
+            dir = a
+        elif o in ("-n", "--count"):
+            count = int(a)
+        elif o in ("-r", "--passes"):
+            passes = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    if dir != None:
+        jobs = [ReadJob(path) for path in FindJobs(dir, recurse = True)]
+    else:
+        jobs = synthetic(count)
+
+    # only time files both parsers can read, and make sure they agree on them
+    good = []
+    for data in jobs:
+        try:
+            old = LegacyJob(data)
+            str(old)
+        except Exception:
+            continue
+        if fields(old) != fields(Job(data)):
+            print "parsers disagree on a job file"
+            sys.exit(-1)
+        # the signature used to be printed with the leading zero of each byte dropped
+        if old.Test == '' and not str(old) == JobText(Job(data)) == JobText(JobView(data)):
+            print "text output differs for a job file"
+            sys.exit(-1)
+        good.append(data)
+    print "{0} job files, {1} parsed by both, {2} passes\n".format(len(jobs), len(good), passes)
+
+    before = timeit("LegacyJob", LegacyJob, good, passes)
+    after = timeit("Job", Job, good, passes)
+    print "\n{0:.1f}x\n".format(after / before)
+
+    before = timeit("LegacyJob, text", lambda data: str(LegacyJob(data)), good, passes)
+    after = timeit("Job, text", lambda data: JobText(Job(data)), good, passes)
+    filters = JobFilters(["Application=evil"])
+    matched = timeit("JobView, -m Application", lambda data: JobMatches(JobView(data), filters), good, passes)
+    print "\n{0:.1f}x text, {1:.1f}x filtering".format(after / before, matched / before)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+#Author: Gleeda <jamie.levy@gmail.com>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version
+#2 of the License, or (at your option) any later version.
+#
+# mdl_parse_bench.py
+#
+# times getmalwaredomains.Domains.rows() against the old slicing parser
+#  (kept below as OldDomains) on pages of growing size.  The pages are either
+#  saved malwaredomainlist.com pages given with -f, which are repeated to
+#  make bigger pages, or synthetic ones.  The time per row should stay flat
+#  for rows() and grow with the page for the old parser
+import sys
+import getopt
+import random
+import time
+
+from getmalwaredomains import Domains
+
+def usage():
+    print 'mdl_parse_bench.py:'
+    print '  - times the malwaredomainlist.com page parsers on growing pages'
+    print '\t-h, --help     : print help message'
+    print '\t-f, --file     : saved page to build the test pages from (default synthetic)'
+    print '\t-r, --rows     : rows in the biggest page (default 16000)'
+    print '\t-o, --old      : largest page (rows) to time the old parser on (default 8000)\n'
+
+class OldDomains(Domains):
+    # the parser as it was, every find and slice works on a copy of the rest of the page
+    def process_column(self, column, ncol):
+        start_value = column.find('>')
+        if start_value == -1:
+            return
+        column = column[start_value+1:]
+        end_column = column.find('</td>')
+        if end_column == -1:
+            return
+        return self.process_value(column[0:end_column], ncol)
+
+    def process_row(self, row):
+        end_row = row.find('</tr>')
+        if end_row == -1:
+            return
+        row = row[0:end_row]
+        offset = 0
+        ncol = 0
+        row_info = {}
+        while row[offset:].find('<td') != -1:
+            ofs = row[offset:].find('<td') + 3
+            column = row[offset+ofs:]
+            info = self.process_column(column, ncol)
+            if info != None:
+                row_info.update(info)
+            offset += ofs
+            ncol += 1
+            ncol = ncol % 8
+        return row_info
+
+    def extract(self):
+        data = self.data
+        table_data = ''
+        start_table = data.find('Date (UTC)')
+        if start_table != -1:
+            end_table = data[start_table:].find('</table>')
+            if end_table != -1:
+                table_data = data[start_table:start_table+end_table]
+        offset = 0
+        nrow = 0
+        domain_info = []
+        while table_data[offset:].find('<tr') != -1:
+            ofs = table_data[offset:].find('<tr') + 4
+            row = table_data[offset+ofs:]
+            if nrow > 0:
+                domain_info.append(self.process_row(row))
+            offset += ofs
+            nrow += 1
+        return domain_info
+
+def synthetic_rows(count, seed = 1):
+    r = random.Random(seed)
+    rows = []
+    for i in xrange(count):
+        rows.append('<tr><td><nobr>%d/%02d/%02d_%02d:%02d</nobr></td><td>%s.example%d.com/<wbr>%s</td>'
+                '<td>%d.%d.%d.%d</td><td>host%d.example.net.</td><td>trojan</td><td>-</td><td>%d</td>'
+                '<td><img src="/images/flags/us.gif"></td></tr>' % (r.randint(2009, 2015), r.randint(1, 12),
+                r.randint(1, 28), r.randint(0, 23), r.randint(0, 59), r.choice("abcdefgh") * r.randint(3, 12),
+                r.randint(0, 999), r.choice(["index.php", "load.exe", "x/y/z.js"]), r.randint(1, 223), r.randint(0, 255),
+                r.randint(0, 255), r.randint(1, 254), i, r.randint(1000, 65000)))
+    return rows
+
+def page_rows(filename):
+    # the rows of a saved page, so they can be repeated into bigger pages
+    f = open(filename, "rb")
+    data = f.read()
+    f.close()
+    start = data.find('Date (UTC)')
+    end = data.find('</table>', start)
+    if start == -1 or end == -1:
+        print "%s has no domain table" % filename
+        sys.exit(-1)
+    first = data.find('<tr', start, end)
+    return data[:first], ['<tr' + row for row in data[first:end].split('<tr')[1:]], data[end:]
+
+def build(head, rows, tail, count):
+    body = (rows * (count / len(rows) + 1))[:count]
+    return head + "\n".join(body) + tail
+
+def timeit(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hf:r:o:", ["help", "file=", "rows=", "old="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    filename = None
+    maxrows = 16000
+    oldrows = 8000
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-f", "--file"):
+            filename = a
+        elif o in ("-r", "--rows"):
+            maxrows = int(a)
+        elif o in ("-o", "--old"):
+            oldrows = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    if filename != None:
+        head, rows, tail = page_rows(filename)
+    else:
+        head = '<html><body><table><tr><th>Date (UTC)</th><th>Domain</th><th>IP</th></tr>\n<tr><td></td></tr>\n'
+        rows = synthetic_rows(1000)
+        tail = '\n</table></body></html>'
+
+    print "%8s %10s %12s %12s %12s %12s" % ("rows", "bytes", "rows() s", "us/row", "old s", "us/row")
+    count = 250
+    while count <= maxrows:
+        data = build(head, rows, tail, count)
+        elapsed, new = timeit(lambda: list(Domains(data).rows()))
+        line = "%8d %10d %12.3f %12.1f" % (count, len(data), elapsed, elapsed * 1e6 / count)
+        if count <= oldrows:
+            oldelapsed, old = timeit(lambda: OldDomains(data).extract())
+            if old != new:
+                print "parsers disagree on a page of %d rows" % count
+                sys.exit(-1)
+            line += " %12.3f %12.1f" % (oldelapsed, oldelapsed * 1e6 / count)
+        print line
+        count *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+#Author: Gleeda <jamie.levy@gmail.com>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version
+#2 of the License, or (at your option) any later version.
+#
+# mdl_query_bench.py
+#
+# builds a synthetic malwaredomains database (reused if it exists) and times
+#  getmalwaredomains.search() against the LIKE / full scan queries it replaces.
+#  The scans use NOT INDEXED so they run the way they did before the indexes
+import os, sys
+import getopt
+import random
+import time
+import sqlite3
+import itertools
+
+import getmalwaredomains
+from getmalwaredomains import search, init, process_domains
+
+def usage():
+    print 'mdl_query_bench.py:'
+    print '  - times malwaredomains database searches on a synthetic database'
+    print '\t-h, --help     : print help message'
+    print '\t-d, --database : database to build or reuse (default mdl_bench.db)'
+    print '\t-n, --rows     : rows in the database when building it (default 2000000)'
+    print '\t-r, --repeat   : runs of each query, the best is reported (default 3)\n'
+
+words = ["update", "secure", "login", "cdn", "mail", "files", "download", "static", "img", "bank",
+         "pay", "account", "verify", "free", "soft", "media", "web", "news", "shop", "cloud"]
+tlds = ["com", "net", "org", "ru", "cn", "info", "biz", "in", "br", "de"]
+
+def synthetic(count, seed = 1):
+    r = random.Random(seed)
+    for i in xrange(count):
+        host = "%s%d.%s%s.%s" % (r.choice(words), r.randint(0, 99), r.choice(words), r.choice(words), r.choice(tlds))
+        if r.random() < 0.3:
+            host = r.choice(words) + "." + host
+        ip = "%d.%d.%d.%d" % (r.randint(1, 223), r.randint(0, 255), r.randint(0, 255), r.randint(1, 254))
+        yield {'domains': host + "/" + r.choice(words) + ".php",
+               'ips': ip,
+               'rlookups': "ip-%s.%s.%s" % (ip.replace('.', '-'), r.choice(words), r.choice(tlds)),
+               'dates': "%d/%02d/%02d %02d:%02d" % (r.randint(2009, 2015), r.randint(1, 12), r.randint(1, 28),
+                        r.randint(0, 23), r.randint(0, 59))}
+
+def build(count):
+    init()
+    rows = synthetic(count)
+    done = 0
+    while done < count:
+        chunk = list(itertools.islice(rows, 100000))
+        process_domains(chunk)
+        done += len(chunk)
+
+def best(func, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), len(result)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:n:r:", ["help", "database=", "rows=", "repeat="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    getmalwaredomains.DBNAME = "mdl_bench.db"
+    count = 2000000
+    repeat = 3
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-d", "--database"):
+            getmalwaredomains.DBNAME = a
+        elif o in ("-n", "--rows"):
+            count = int(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    if not os.path.isfile(getmalwaredomains.DBNAME):
+        start = time.time()
+        build(count)
+        print "built %s in %.1fs" % (getmalwaredomains.DBNAME, time.time() - start)
+    init()
+
+    conn = sqlite3.connect(getmalwaredomains.DBNAME)
+    conn.text_factory = str
+    conn.create_function("hostsuffix", 2, getmalwaredomains.hostsuffix)
+    print "%d rows\n" % conn.execute("SELECT COUNT(*) FROM domains").fetchone()[0]
+
+    scan = "SELECT domain, ip, rlookup, date FROM domains NOT INDEXED WHERE "
+    ip = conn.execute("SELECT ip FROM domains WHERE id = (SELECT MAX(id) / 2 FROM domains)").fetchone()[0]
+    block = ".".join(ip.split(".")[:2])
+    cases = [
+        ("substring 'bankpay'",
+            lambda: search(conn, match = "bankpay"),
+            lambda: conn.execute(scan + "domain LIKE ? OR rlookup LIKE ?", ("%bankpay%", "%bankpay%")).fetchall()),
+        ("suffix 'bankpay.ru'",
+            lambda: search(conn, suffix = "bankpay.ru"),
+            lambda: conn.execute(scan + "domain LIKE ? AND hostsuffix(domain, ?)", ("%bankpay.ru%", "bankpay.ru")).fetchall()),
+        ("ip " + ip,
+            lambda: search(conn, ip = ip),
+            lambda: conn.execute(scan + "ip = ?", (ip,)).fetchall()),
+        ("cidr " + block + ".0.0/16",
+            lambda: search(conn, ip = block + ".0.0/16"),
+            lambda: conn.execute(scan + "ip LIKE ?", (block + ".%",)).fetchall()),
+        ("dates 2012/06/01 - 2012/06/03",
+            lambda: search(conn, since = "2012/06/01", until = "2012/06/03"),
+            lambda: conn.execute(scan + "date >= ? AND date < ?", ("2012/06/01", "2012/06/03~")).fetchall()),
+        ("substring + dates",
+            lambda: search(conn, match = "securecdn", since = "2014/01/01", until = "2014/12/31"),
+            lambda: conn.execute(scan + "(domain LIKE ? OR rlookup LIKE ?) AND date >= ? AND date < ?",
+                ("%securecdn%", "%securecdn%", "2014/01/01", "2014/12/31~")).fetchall()),
+    ]
+    print "%-32s %8s %12s %12s %8s" % ("query", "rows", "search() s", "scan s", "speedup")
+    for name, indexed, scanned in cases:
+        elapsed, rows = best(indexed, repeat)
+        scanelapsed, scanrows = best(scanned, repeat)
+        if rows != scanrows:
+            print "%s: search() found %d rows, the scan %d" % (name, rows, scanrows)
+        print "%-32s %8d %12.4f %12.4f %7.0fx" % (name, rows, elapsed, scanelapsed, scanelapsed / max(elapsed, 1e-6))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
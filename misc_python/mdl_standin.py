@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+#Author: Gleeda <jamie.levy@gmail.com>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version
+#2 of the License, or (at your option) any later version.
+#
+# mdl_standin.py
+#
+# serves recorded malwaredomainlist.com pages so getmalwaredomains.py can be
+#  run without the real site:
+#
+#   mdl_standin.py -d pages -p 8080
+#   getmalwaredomains.py -s localhost:8080 -b 10
+#
+# page N of the list is pages/page<N>.html, the update link is
+#  pages/update.html.  Connections are kept alive, pages carry an ETag and
+#  Last-Modified and conditional requests get a 304.  Each request is logged
+#  with the client port, so requests sharing a connection show the same port
+import os, sys
+import getopt
+import random
+import hashlib
+import urlparse
+import email.utils
+import BaseHTTPServer
+import SocketServer
+
+def usage():
+    print 'mdl_standin.py:'
+    print '  - serves recorded malwaredomainlist.com pages for getmalwaredomains.py'
+    print '\t-h, --help     : print help message'
+    print '\t-d, --dir      : directory with page<N>.html and update.html (default .)'
+    print '\t-p, --port     : port to listen on (default 8080)'
+    print '\t-f, --fail     : fraction of requests answered with 503, to exercise retries (default 0)\n'
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pagedir = "."
+    fail = 0.0
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == "/update.php":
+            name = "update.html"
+        elif url.path == "/mdl.php" and "page" in query:
+            name = "page" + query["page"][0] + ".html"
+        else:
+            name = None
+        if name == None or not os.path.isfile(os.path.join(self.pagedir, name)):
+            self.reply(404, "")
+            return
+        if random.random() < self.fail:
+            self.reply(503, "")
+            return
+
+        filename = os.path.join(self.pagedir, name)
+        f = open(filename, "rb")
+        data = f.read()
+        f.close()
+        mtime = int(os.path.getmtime(filename))
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        headers = {"ETag": etag, "Last-Modified": email.utils.formatdate(mtime, usegmt = True)}
+        if self.headers.getheader("If-None-Match") == etag:
+            self.reply(304, None, headers)
+            return
+        since = self.headers.getheader("If-Modified-Since")
+        if since != None and self.headers.getheader("If-None-Match") == None:
+            parsed = email.utils.parsedate_tz(since)
+            if parsed != None and email.utils.mktime_tz(parsed) >= mtime:
+                self.reply(304, None, headers)
+                return
+        self.reply(200, data, headers)
+
+    def reply(self, status, data, headers = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if data != None:
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        sys.stderr.write("[%d] %s\n" % (self.client_address[1], format % args))
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:p:f:", ["help", "dir=", "port=", "fail="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    port = 8080
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif o in ("-d", "--dir"):
+            StandInHandler.pagedir = a
+        elif o in ("-p", "--port"):
+            port = int(a)
+        elif o in ("-f", "--fail"):
+            StandInHandler.fail = float(a)
+        else:
+            assert False, "unhandled option\n\n"
+            sys.exit(2)
+
+    server = StandInServer(("127.0.0.1", port), StandInHandler)
+    print "Serving %s on port %d" % (StandInHandler.pagedir, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,37 @@
 # pf_baseline allows one to quickly find uncommon prefetch files by calculating a list from baseline
 #   prefetch names from known paths.  Items that are not in that baseline are printed.
 # hashing functions  are taken from Yogesh Khatri's EnScript for prefetch
+#   if numpy is installed, whole lists of paths are hashed at once
 
 import ctypes
 import getopt, sys, os
 import sqlite3
+import hashlib
+import marshal
+import multiprocessing
+import threading
+import Queue
+
+try:
+    import resource
+    has_resource = True
+except ImportError:
+    has_resource = False
+
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+# number of paths hashed per numpy batch, keeps the padded arrays bounded
+BATCHSIZE = 65536
+# bump this if the cache file layout changes
+CACHEVERSION = 1
+# rows fetched from the baseline database at a time
+FETCHSIZE = 10000
+# expression index on the extension so the exe filter doesn't scan the whole table
+EXTINDEX = "entries_ext"
 
 def usage():
     print 'pf_baseline.py:'
@@ -18,8 +45,18 @@ def usage():
     print '\t                      (or any sqlite3 db with same schema: SELECT path FROM entries WHERE path LIKE \'%exe\')'
     print '\t-l, --location   : Directory of prefetch files'
     print '\t-n, --numvols    : Number of volumes to create baseline for (e.g. -n 3 : harddiskvolume1, harddiskvolume2, harddiskvolume3)'
-    print '\t-p, --particular : A particular volume to create the baseline for (e.g. -p 2 : harddiskvolume2)\n'
-    print "Example usage:\n\t$ python pf_baseline.py -d baseline.db -v -l /path/to/prefetch/files\n"
+    print '\t-p, --particular : A particular volume to create the baseline for (e.g. -p 2 : harddiskvolume2)'
+    print '\t-c, --cache      : Directory to keep generated baselines in, reused when the database, OS and volumes match'
+    print '\t-s, --sweep      : Directory containing one prefetch directory per host (instead of -l)'
+    print '\t-w, --workers    : Number of worker processes for sweep mode (default number of CPUs)'
+    print '\t-i, --index      : Add an extension index to the baseline database (once) so exes are found without a table scan'
+    print '\t-m, --memory     : Print the number of paths hashed and peak RSS to stderr'
+    print '\t-r, --reverse    : Reverse index (prefetch name -> paths) for XP and Vista, built from -d if given'
+    print '\t-f, --find       : Prefetch file name to look up in the reverse index\n'
+    print "Example usage:\n\t$ python pf_baseline.py -d baseline.db -v -l /path/to/prefetch/files"
+    print "\t$ python pf_baseline.py -d baseline.db -v -s /path/to/hosts -w 8"
+    print "\t$ python pf_baseline.py -d baseline.db -n 3 -r reverse.db"
+    print "\t$ python pf_baseline.py -r reverse.db -f NOTEPAD.EXE-D8414F97.pf\n"
 
 class PFBaseline:
 
@@ -27,34 +64,166 @@ class PFBaseline:
         self.volume = "\\device\\harddiskvolume"
         self.XP = XP
         self.numvolumes = numvolumes
-        self.prefetches = []
-        # appending other known files in Windows\Prefetch:
-        self.prefetches.append("NTOSBOOT-B00DFAAD.pf")
-        self.prefetches.append("Layout.ini")
+        self.prefetches = set()
+        # adding other known files in Windows\Prefetch:
+        self.prefetches.add("NTOSBOOT-B00DFAAD.pf")
+        self.prefetches.add("Layout.ini")
 
 
     def GenOneVolHashes(self, cmds, volume = 1):
-        for c in cmds:
-            exe = c.split("\\")[-1].upper()
-            cmd = self.volume + str(volume) + "\\" + c 
-            if self.XP:
-                item = "{0}-{1:08X}.pf".format(exe, self.generateXpHash(cmd.upper()))
-            else:
-                item = "{0}-{1:08X}.pf".format(exe, self.generateVistaHash(cmd.upper()))
-            if item not in self.prefetches:
-                self.prefetches.append(item)
+        self.GenVolHashes(cmds, [volume])
 
     def GenAllVolHashes(self, cmds):
-        for c in cmds:
-            exe = c.split("\\")[-1].upper()
-            for i in xrange(1, self.numvolumes + 1):
-                cmd = self.volume + str(i) + "\\" + c
+        self.GenVolHashes(cmds, xrange(1, self.numvolumes + 1))
+
+    def GenVolHashes(self, cmds, volumes):
+        '''
+        The volume prefix is the only thing that changes between volumes, so
+        each path is folded once and then combined with the fold state of
+        every \\device\\harddiskvolumeN\\ prefix:
+            fold(prefix + suffix) = fold(prefix) * 1369 ** len(suffix) + fold(suffix)
+        '''
+        for volume, exes, hashes in self.VolHashes(cmds, volumes):
+            for exe, hash in zip(exes, hashes):
+                self.prefetches.add("{0}-{1:08X}.pf".format(exe, hash))
+
+    def VolHashes(self, cmds, volumes):
+        # yields (volume, exe names, hashes) with the hashes in the same order as cmds
+        exes = [c.split("\\")[-1].upper() for c in cmds]
+        suffixes = [c.upper() for c in cmds]
+        if has_numpy:
+            folds, scales = self._foldHashes(suffixes, 0)
+        else:
+            parts = [self.foldHash(c) for c in suffixes]
+        for i in volumes:
+            prefix = self.prefixState(i)
+            if has_numpy:
+                hashes = numpy.uint32(prefix) * scales + folds
                 if self.XP:
-                    item = "{0}-{1:08X}.pf".format(exe, self.generateXpHash(cmd.upper()))
+                    hashes = self._finishXpHashes(hashes)
                 else:
-                    item = "{0}-{1:08X}.pf".format(exe, self.generateVistaHash(cmd.upper()))
-                if item not in self.prefetches:
-                    self.prefetches.append(item)
+                    hashes = [int(h) for h in hashes]
+            else:
+                hashes = [ctypes.c_uint32(prefix * scale + fold).value for fold, scale in parts]
+                if self.XP:
+                    hashes = [self.finishXpHash(h) for h in hashes]
+            yield i, exes, hashes
+
+    def save(self, filename):
+        f = open(filename + ".tmp", "wb")
+        try:
+            marshal.dump(sorted(self.prefetches), f)
+        finally:
+            f.close()
+        # rename so an interrupted run never leaves a partial cache behind
+        os.rename(filename + ".tmp", filename)
+
+    def load(self, filename):
+        f = open(filename, "rb")
+        try:
+            self.prefetches.update(marshal.load(f))
+        finally:
+            f.close()
+
+    def prefixState(self, volume):
+        # XP and Vista only differ in the seed of the fold
+        seed = 0 if self.XP else 314159
+        return self.foldHash((self.volume + str(volume) + "\\").upper(), seed)[0]
+
+    def foldHash(self, cmd, hash = 0):
+        '''
+        Folds cmd into hash and returns (hash, 1369 ** len(cmd)), both as uint32
+        so that the result can be composed with any prefix state.
+        '''
+        uni = unicode(cmd)
+        for i in range(len(uni)):
+            num = ord(uni[i])
+            if (num > 255):
+                hash = ctypes.c_uint32(37 * ((37 * hash) + (num / 256)) + (num % 256)).value
+            else:
+                hash = ctypes.c_uint32(37 * ((37 * hash) + num)).value
+        # 1369 ** len mod 2 ** 32, without a ctypes call per character
+        return ctypes.c_uint32(hash).value, pow(1369, len(uni), 2 ** 32)
+
+    def finishXpHash(self, hash):
+        hash = ctypes.c_int32(hash).value
+        hash *= 314159269
+        hash = ctypes.c_int32(hash).value
+        if hash < 0:
+            hash *= -1
+        hash %= 1000000007
+        return ctypes.c_uint32(hash).value
+
+    def generateHashes(self, cmds):
+        '''
+        Hashes a list of (already uppercased) kernel paths with the algorithm
+        selected for this baseline.  Uses the numpy batch functions if
+        numpy is installed, otherwise falls back to the scalar ones.
+        '''
+        if self.XP:
+            if has_numpy:
+                return self.generateXpHashes(cmds)
+            return [self.generateXpHash(c) for c in cmds]
+        if has_numpy:
+            return self.generateVistaHashes(cmds)
+        return [self.generateVistaHash(c) for c in cmds]
+
+    def _foldHashes(self, cmds, seed):
+        '''
+        Runs the 37 * (37 * hash + ...) fold over a list of paths one column
+        of characters at a time.  Each character does hash = 1369 * hash + step,
+        and uint32 arithmetic wraps the same way ctypes.c_int32 does.  Paths
+        are sorted longest first so the rows still being hashed at any column
+        are a prefix of the padded array.  Returns the folds and, for
+        composing with a prefix state, 1369 ** len(path) for each path.
+        '''
+        # narrow builds iterate unicode strings as UTF-16 code units
+        if sys.maxunicode > 0xFFFF:
+            codec, dtype = "utf-32-le", "<u4"
+        else:
+            codec, dtype = "utf-16-le", "<u2"
+        width = numpy.dtype(dtype).itemsize
+        hashes = numpy.zeros(len(cmds), dtype = numpy.uint32)
+        scales = numpy.zeros(len(cmds), dtype = numpy.uint32)
+        for start in xrange(0, len(cmds), BATCHSIZE):
+            chunk = [unicode(c).encode(codec) for c in cmds[start:start + BATCHSIZE]]
+            lengths = numpy.array([len(c) for c in chunk], dtype = numpy.int64) // width
+            order = numpy.argsort(-lengths, kind = "mergesort")
+            chunk = [chunk[i] for i in order]
+            lengths = lengths[order]
+            maxlen = int(lengths[0])
+
+            # scatter the flat code units into a padded (path, column) array
+            units = numpy.frombuffer("".join(chunk), dtype = dtype).astype(numpy.uint32)
+            rows = numpy.repeat(numpy.arange(len(chunk)), lengths)
+            cols = numpy.arange(len(units)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+            padded = numpy.zeros((len(chunk), maxlen), dtype = numpy.uint32)
+            padded[rows, cols] = units
+            steps = numpy.where(padded > 255, 37 * (padded // 256) + (padded % 256), 37 * padded).astype(numpy.uint32)
+
+            # active[col] is the number of paths longer than col
+            active = numpy.searchsorted(-lengths, -numpy.arange(maxlen), side = "left")
+            hash = numpy.empty(len(chunk), dtype = numpy.uint32)
+            hash.fill(seed)
+            for col in xrange(maxlen):
+                n = active[col]
+                hash[:n] = hash[:n] * numpy.uint32(1369) + steps[:n, col]
+            hashes[start + order] = hash
+            scales[start + order] = numpy.power(numpy.uint32(1369), lengths.astype(numpy.uint32))
+        return hashes, scales
+
+    # batch versions of generateXpHash/generateVistaHash, these return the same values
+    def generateXpHashes(self, cmds):
+        return self._finishXpHashes(self._foldHashes(cmds, 0)[0])
+
+    def generateVistaHashes(self, cmds):
+        return [int(h) for h in self._foldHashes(cmds, 314159)[0]]
+
+    def _finishXpHashes(self, hashes):
+        hash = hashes.view(numpy.int32).astype(numpy.int64)
+        hash = ((hash * 314159269) & 0xFFFFFFFF).astype(numpy.uint32).view(numpy.int32).astype(numpy.int64)
+        hash = numpy.abs(hash) % 1000000007
+        return [int(h) for h in hash]
 
     def generateXpHash(self, cmd):
         hash = 0 
@@ -83,9 +252,199 @@ class PFBaseline:
                 hash = ctypes.c_int32(37 * ((37 * hash) + num)).value
         return ctypes.c_uint32(hash).value
 
+def Uncommon(prefetches, dir):
+    items = []
+    for fname in os.listdir(dir):
+        if os.path.isfile(os.path.join(dir, fname)):
+            if fname not in prefetches:
+                items.append(fname)
+    return items
+
+# baseline set for the sweep workers.  On fork platforms the initializer
+# arguments are inherited, so the set is shared copy-on-write rather than
+# pickled to each worker
+_baseline = None
+
+def _init_worker(prefetches):
+    global _baseline
+    _baseline = prefetches
+
+def _sweep_host(args):
+    host, dir = args
+    try:
+        return host, Uncommon(_baseline, dir), None
+    except OSError, e:
+        return host, [], str(e)
+
+def Sweep(prefetches, root, workers = None):
+    '''
+    Runs Uncommon over every host directory under root.  Returns a list of
+    (host, uncommon prefetch files, error) and a {prefetch file: number of
+    hosts} rollup for stacking
+    '''
+    hosts = []
+    for host in sorted(os.listdir(root)):
+        if os.path.isdir(os.path.join(root, host)):
+            hosts.append((host, os.path.join(root, host)))
+
+    pool = multiprocessing.Pool(processes = workers, initializer = _init_worker, initargs = (prefetches,))
+    try:
+        results = pool.map(_sweep_host, hosts, chunksize = max(1, len(hosts) / (4 * (workers or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+
+    counts = {}
+    for host, items, error in results:
+        for fname in items:
+            counts[fname] = counts.get(fname, 0) + 1
+    return results, counts
+
+def CreateExtIndex(base):
+    rc = sqlite3.connect(base)
+    rc.execute("CREATE INDEX IF NOT EXISTS {0} ON entries(lower(substr(path, -3)))".format(EXTINDEX))
+    rc.commit()
+    rc.close()
+
+def _read_paths(base, batches):
+    # the end of stream marker always goes out, StreamPaths waits for it
+    rc = None
+    try:
+        rc = sqlite3.connect(base)
+        cur = rc.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", (EXTINDEX,))
+        if cur.fetchone() != None:
+            # LIKE is case insensitive, so this matches the same rows
+            q = "SELECT path FROM entries WHERE lower(substr(path, -3)) = 'exe'"
+        else:
+            q = "SELECT path FROM entries WHERE path LIKE '%exe'"
+        cur.execute(q)
+        while True:
+            rows = cur.fetchmany(FETCHSIZE)
+            if not rows:
+                break
+            batches.put([r[0] for r in rows])
+    except Exception, e:
+        batches.put(e)
+    finally:
+        if rc != None:
+            rc.close()
+        batches.put(None)
+
+def StreamPaths(base):
+    '''
+    Yields lists of exe paths from the baseline database.  The rows are read
+    on another thread (sqlite releases the GIL) so hashing one batch overlaps
+    reading the next, and only a few batches are held in memory at once
+    '''
+    batches = Queue.Queue(maxsize = 4)
+    reader = threading.Thread(target = _read_paths, args = (base, batches))
+    reader.daemon = True
+    reader.start()
+    while True:
+        batch = batches.get()
+        if batch == None:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+    reader.join()
+
+def PeakRSS():
+    # ru_maxrss is in kilobytes on Linux but bytes on OS X
+    if not has_resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss
+
+def BuildReverseIndex(base, reverse, volumes):
+    '''
+    Hashes every baseline path with both algorithms and stores the results
+    in a sqlite db indexed on (hash, exe), so a prefetch name can be turned
+    back into candidate paths with one B-tree lookup
+    '''
+    if os.path.isfile(reverse):
+        os.remove(reverse)
+    rc = sqlite3.connect(reverse)
+    rc.executescript('''
+    CREATE TABLE paths (
+            id          INTEGER PRIMARY KEY,
+            path        TEXT
+        );
+    CREATE TABLE hashes (
+            exe         TEXT,
+            hash        INTEGER,
+            os          TEXT,
+            volume      INTEGER,
+            path_id     INTEGER
+        );
+    ''')
+    baselines = [("XP", PFBaseline(XP = True)), ("Vista", PFBaseline(XP = False))]
+    pathid = 0
+    for cmds in StreamPaths(base):
+        ids = range(pathid + 1, pathid + len(cmds) + 1)
+        pathid += len(cmds)
+        rc.executemany("INSERT INTO paths VALUES(?, ?)", zip(ids, cmds))
+        for os_name, p in baselines:
+            for volume, exes, hashes in p.VolHashes(cmds, volumes):
+                rc.executemany("INSERT INTO hashes VALUES(?, ?, ?, ?, ?)",
+                        ((exe, hash, os_name, volume, id) for exe, hash, id in zip(exes, hashes, ids)))
+    # building the index after the inserts is much faster than maintaining it
+    rc.execute("CREATE INDEX hashes_lookup ON hashes(hash, exe)")
+    rc.commit()
+    rc.close()
+
+def ReverseLookup(reverse, fname):
+    '''
+    Returns (os, volume, full path) for every baseline path that produces
+    the prefetch file name fname (e.g. NOTEPAD.EXE-D8414F97.pf)
+    '''
+    name = fname
+    if name.lower().endswith(".pf"):
+        name = name[:-3]
+    exe, hash = name.rsplit("-", 1)
+    hash = int(hash, 16)
+    rc = sqlite3.connect(reverse)
+    cur = rc.cursor()
+    cur.execute('''SELECT hashes.os, hashes.volume, paths.path FROM hashes, paths
+            WHERE hashes.hash = ? AND hashes.exe = ? AND paths.id = hashes.path_id''', (hash, exe.upper()))
+    results = []
+    for os_name, volume, path in cur.fetchall():
+        results.append((os_name, volume, "\\device\\harddiskvolume" + str(volume) + "\\" + path))
+    rc.close()
+    return results
+
+def CacheName(cache, base, xp, volumes):
+    '''
+    Cached baselines are named after the content of the baseline database
+    plus the OS and volumes they were generated for
+    '''
+    h = hashlib.sha1()
+    f = open(base, "rb")
+    try:
+        for block in iter(lambda: f.read(1024 * 1024), ""):
+            h.update(block)
+    finally:
+        f.close()
+    h.update("|v{0}|{1}|{2}".format(CACHEVERSION, "xp" if xp else "vista", ",".join(str(v) for v in volumes)))
+    return os.path.join(cache, "pf_baseline-" + h.hexdigest() + ".cache")
+
+def PrintLookup(reverse, find):
+    try:
+        results = ReverseLookup(reverse, find)
+    except ValueError:
+        print "Not a prefetch file name: " + find
+        return
+    if len(results) == 0:
+        print "No baseline paths found for " + find
+    for os_name, volume, path in results:
+        print "{0}\t{1}".format(os_name, path)
+
 def main():    
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hvxn:d:p:l:", ["help", "location=", "database=", "numvols=", "particular=", "xp", "vista"])
+        opts, args = getopt.getopt(sys.argv[1:], "hvxn:d:p:l:c:s:w:imr:f:", ["help", "location=", "database=", "numvols=", "particular=", "cache=", "sweep=", "workers=", "index", "memory", "reverse=", "find=", "xp", "vista"])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
@@ -95,6 +454,13 @@ def main():
     vols = None
     base = None
     dir = None
+    cache = None
+    sweep = None
+    workers = None
+    index = False
+    memory = False
+    reverse = None
+    find = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -111,43 +477,92 @@ def main():
             vol = a
         elif o in ("-l", "--location"):
             dir = a
+        elif o in ("-c", "--cache"):
+            cache = a
+        elif o in ("-s", "--sweep"):
+            sweep = a
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-i", "--index"):
+            index = True
+        elif o in ("-m", "--memory"):
+            memory = True
+        elif o in ("-r", "--reverse"):
+            reverse = a
+        elif o in ("-f", "--find"):
+            find = a
         else:
             assert False, "unhandled option\n\n"
             return
 
+    if reverse != None and find != None and not base:
+        PrintLookup(reverse, find)
+        return
+
     if not base:
         print "No database specified!"
         usage()
         return
 
-    if not dir:
+    if not dir and not sweep and reverse == None:
         print "No directory of prefetch files specified!"
         usage()
         return
 
-    cmds = []
-    rc = sqlite3.connect(base)
-    cur = rc.cursor()
-    q = "SELECT path FROM entries WHERE path LIKE '%exe'"
-    for i in cur.execute(q):
-        cmds.append(i[0])
-    rc.close()
-
     if vols != None:
         p = PFBaseline(XP = xp, numvolumes = int(vols))
-        p.GenAllVolHashes(cmds = cmds)
+        volumes = range(1, int(vols) + 1)
     elif vol != None:
         p = PFBaseline(XP = xp)
-        p.GenOneVolHashes(cmds = cmds, volume = int(vol))
+        volumes = [int(vol)]
     else:
         p = PFBaseline(XP = xp)
-        p.GenOneVolHashes(cmds = cmds)
+        volumes = [1]
 
-    os.chdir(dir)
-    for fname in os.listdir(dir):
-        if os.path.isfile(os.path.join(dir, fname)):
-            if fname not in p.prefetches:
-                print fname
+    if index:
+        CreateExtIndex(base)
+
+    if reverse != None:
+        BuildReverseIndex(base, reverse, volumes)
+        if find != None:
+            PrintLookup(reverse, find)
+        return
+
+    cachefile = None
+    if cache != None:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        cachefile = CacheName(cache, base, xp, volumes)
+
+    if cachefile != None and os.path.isfile(cachefile):
+        p.load(cachefile)
+    else:
+        total = 0
+        for cmds in StreamPaths(base):
+            p.GenVolHashes(cmds = cmds, volumes = volumes)
+            total += len(cmds)
+        if cachefile != None:
+            p.save(cachefile)
+        if memory:
+            sys.stderr.write("Hashed {0} paths\n".format(total))
+
+    if memory and has_resource:
+        sys.stderr.write("Peak RSS: {0:.1f} MB\n".format(PeakRSS() / 1024.0))
+
+    if sweep:
+        results, counts = Sweep(p.prefetches, sweep, workers = workers)
+        for host, items, error in results:
+            if error != None:
+                print "{0}: ERROR {1}".format(host, error)
+            for fname in sorted(items):
+                print "{0}: {1}".format(host, fname)
+        print "\nFrequency of occurrence (hosts: prefetch file)"
+        for fname, count in sorted(counts.items(), key = lambda x: (x[1], x[0])):
+            print "{0:5}: {1}".format(count, fname)
+        return
+
+    for fname in Uncommon(p.prefetches, dir):
+        print fname
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,88 @@
+# author: Gleeda
+#
+# prefetch_bench.py
+#   measures prefetch hashing throughput (paths/sec) for the scalar functions in
+#   prefetch_hash.py and pf_baseline.py and, if numpy is installed, the batch
+#   functions in pf_baseline.py.  The corpus is synthetic and generated from a
+#   fixed seed so numbers are comparable between runs and machines
+
+import getopt, sys
+import random
+import time
+
+import prefetch_hash
+import pf_baseline
+
+dirs = [
+    "windows",
+    "windows\\system32",
+    "windows\\syswow64",
+    "windows\\system32\\drivers",
+    "program files",
+    "program files (x86)",
+    "program files\\common files\\microsoft shared",
+    "users\\administrator\\appdata\\local\\temp",
+    "documents and settings\\all users\\application data",
+]
+
+def usage():
+    print 'prefetch_bench.py:'
+    print '  - measures prefetch hashing throughput (paths/sec) on a synthetic corpus'
+    print '\t-h, --help     : print help message'
+    print '\t-c, --count    : number of paths in the corpus (default 100000)'
+    print '\t-s, --seed     : random seed for the corpus (default 1)\n'
+
+def corpus(count, seed):
+    r = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz0123456789_-"
+    paths = []
+    for i in xrange(count):
+        depth = r.randint(0, 3)
+        path = r.choice(dirs)
+        for d in xrange(depth):
+            path += "\\" + "".join(r.choice(letters) for j in xrange(r.randint(3, 12)))
+        path += "\\" + "".join(r.choice(letters) for j in xrange(r.randint(3, 12))) + ".exe"
+        paths.append(("\\device\\harddiskvolume1\\" + path).upper())
+    return paths
+
+def timeit(name, func, paths):
+    start = time.time()
+    func(paths)
+    elapsed = time.time() - start
+    print "{0:40} {1:10.2f}s {2:12.0f} paths/sec".format(name, elapsed, len(paths) / elapsed)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:s:", ["help", "count=", "seed="])
+    except getopt.GetoptError, err:
+        print str(err)
+        sys.exit(2)
+
+    count = 100000
+    seed = 1
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            return
+        elif o in ("-c", "--count"):
+            count = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        else:
+            assert False, "unhandled option\n\n"
+            return
+
+    paths = corpus(count, seed)
+    p = pf_baseline.PFBaseline()
+    print "{0} paths, seed {1}, numpy {2}\n".format(count, seed, "available" if pf_baseline.has_numpy else "not available")
+    timeit("prefetch_hash.generateXpHash", lambda c: [prefetch_hash.generateXpHash(x) for x in c], paths)
+    timeit("prefetch_hash.generateVistaHash", lambda c: [prefetch_hash.generateVistaHash(x) for x in c], paths)
+    timeit("prefetch_hash.foldHash (xp + vista)", lambda c: [prefetch_hash.foldHash(x) for x in c], paths)
+    timeit("PFBaseline.generateXpHash", lambda c: [p.generateXpHash(x) for x in c], paths)
+    timeit("PFBaseline.generateVistaHash", lambda c: [p.generateVistaHash(x) for x in c], paths)
+    if pf_baseline.has_numpy:
+        timeit("PFBaseline.generateXpHashes", p.generateXpHashes, paths)
+        timeit("PFBaseline.generateVistaHashes", p.generateVistaHashes, paths)
+
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,12 @@ def usage():
     print '\t-h, --help     : print help message'
     print '\t-p, --path     : kernel path to a program (not case sensitive)'
     print '\t-x, --xp       : print the name of a prefetch file for XP/2K3'
-    print '\t-v, --vista    : print the name of a prefetch file for Vista/2k8/Win7\n'
+    print '\t-v, --vista    : print the name of a prefetch file for Vista/2k8/Win7'
+    print '\t-n, --numvols  : path is relative to the volume root, print names for harddiskvolume1 through N'
+    print '\t-b, --bulk     : file of kernel paths, one per line ("-" for stdin), prints path<TAB>xp name<TAB>vista name\n'
     print "Example usage:\n\t$ python prefetch_hash.py -p '\\device\\harddiskvolume1\\windows\\system32\\notepad.exe' -v"
+    print "\t$ python prefetch_hash.py -p 'windows\\system32\\notepad.exe' -n 3 -v"
+    print "\t$ python prefetch_hash.py -b paths.txt > names.tsv"
 
 def generateXpHash(cmd):
     hash = 0 
@@ -41,14 +45,74 @@ def generateVistaHash(cmd):
             hash = ctypes.c_int32(37 * ((37 * hash) + num)).value
     return ctypes.c_uint32(hash).value
 
+def foldHash(cmd, hash = 0):
+    '''
+    Both hashes are the same left to right fold, so a path can be split into
+    prefix + suffix:
+        fold(prefix + suffix) = fold(prefix) * 1369 ** len(suffix) + fold(suffix)
+    Returns (hash, 1369 ** len(cmd)) as uint32s so the suffix part only has
+    to be computed once no matter how many prefixes it is combined with.
+    '''
+    uni = unicode(cmd)
+    for i in range(len(uni)):
+        num = ord(uni[i])
+        if (num > 255):
+            hash = ctypes.c_uint32(37 * ((37 * hash) + (num / 256)) + (num % 256)).value
+        else:
+            hash = ctypes.c_uint32(37 * ((37 * hash) + num)).value
+    # 1369 ** len mod 2 ** 32, without a ctypes call per character
+    return ctypes.c_uint32(hash).value, pow(1369, len(uni), 2 ** 32)
+
+def composeHash(prefix, suffix):
+    # prefix is a fold state, suffix is a (hash, scale) pair from foldHash
+    hash, scale = suffix
+    return ctypes.c_uint32(prefix * scale + hash).value
+
+def finishXpHash(hash):
+    hash = ctypes.c_int32(hash).value
+    hash *= 314159269
+    hash = ctypes.c_int32(hash).value
+    if hash < 0:
+        hash *= -1
+    hash %= 1000000007
+    return ctypes.c_uint32(hash).value
+
+def prefetchName(exe, hash):
+    # Windows writes the hash as 8 hex digits, leading zeros included
+    return u"{0}-{1:08X}.pf".format(exe, hash)
+
+def bulk(infile, outfile):
+    '''
+    XP folds from 0 and Vista from 314159, so a single seed 0 fold of each
+    path gives both names.  Lines are handled one at a time so memory use
+    doesn't grow with the input.  Lines that aren't UTF-8 are reported on
+    stderr and skipped
+    '''
+    for number, line in enumerate(infile, 1):
+        line = line.rstrip("\r\n")
+        if line == "":
+            continue
+        try:
+            path = line.decode("utf-8")
+        except UnicodeDecodeError:
+            sys.stderr.write("line {0}: not UTF-8, skipped: {1!r}\n".format(number, line))
+            continue
+        cmd = path.upper()
+        exe = cmd.split("\\")[-1]
+        suffix = foldHash(cmd)
+        outfile.write(u"{0}\t{1}\t{2}\n".format(path, prefetchName(exe, finishXpHash(suffix[0])),
+                prefetchName(exe, composeHash(314159, suffix))).encode("utf-8"))
+
 def main():    
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hvxp:", ["help", "path=", "xp", "vista"])
+        opts, args = getopt.getopt(sys.argv[1:], "hvxp:n:b:", ["help", "path=", "xp", "vista", "numvols=", "bulk="])
     except getopt.GetoptError, err:
         print str(err)
         sys.exit(2)
 
     cmd = None
+    vols = None
+    paths = None
     xp = False
     vista = False
     for o, a in opts:
@@ -61,10 +125,25 @@ def main():
             vista = True
         elif o in ("-p", "--path"):
             cmd = a.upper()
+        elif o in ("-n", "--numvols"):
+            vols = int(a)
+        elif o in ("-b", "--bulk"):
+            paths = a
         else:
             assert False, "unhandled option\n\n"
             sys.exit(2)
 
+    if paths != None:
+        if paths == "-":
+            bulk(sys.stdin, sys.stdout)
+        else:
+            f = open(paths, "r")
+            try:
+                bulk(f, sys.stdout)
+            finally:
+                f.close()
+        return
+
     if cmd == None:
         print "You must enter a path!"
         usage()
@@ -72,12 +151,20 @@ def main():
 
     exe = cmd.split("\\")[-1]
 
+    if vols != None and (xp or vista):
+        suffix = foldHash(cmd)
+        for i in xrange(1, vols + 1):
+            vol = "\\DEVICE\\HARDDISKVOLUME" + str(i) + "\\"
+            if xp:
+                print prefetchName(exe, finishXpHash(composeHash(foldHash(vol)[0], suffix)))
+            if vista:
+                print prefetchName(exe, composeHash(foldHash(vol, 314159)[0], suffix))
+        return
+
     if xp:
-        hash = "%X" % generateXpHash(cmd)
-        print exe + "-" + str(hash) + ".pf"
+        print prefetchName(exe, generateXpHash(cmd))
     if vista:
-        hash = "%X" % generateVistaHash(cmd)
-        print exe + "-" + str(hash) + ".pf"
+        print prefetchName(exe, generateVistaHash(cmd))
     if not xp and not vista:
         print "No type of OS specified!"
         usage()